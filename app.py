@@ -8,6 +8,12 @@ import plotly.express as px
 # Configuração da Página
 st.set_page_config(page_title="FPR Consórcios", page_icon="💰", layout="wide")
 
+# Banco pronto (tabelas/colunas novas) antes de qualquer leitura; uma vez por processo
+try: backend.preparar_banco()
+except Exception as e:
+    st.error(f"Erro preparando banco: {e}")
+    st.stop()
+
 # =========================================================================
 # ESTILOS GLOBAIS (CSS PREMIUM - ADAPTÁVEL AO TEMA CLARO/ESCURO)
 # =========================================================================
@@ -117,6 +123,30 @@ def tela_login():
                 else:
                     st.warning("Preencha todos os campos.")
 
+# =========================================================================
+# UPLOADS (LEITURA EM LOTES COM PROGRESSO)
+# =========================================================================
+def ler_upload(arquivo, perfil=None):
+    # Entrega a planilha (ou o extrato .csv/.txt, lido pelo perfil) em lotes aos processar_*; a barra mostra linhas processadas e o ritmo a cada lote
+    barra = st.progress(0.0, text="Lendo arquivo...")
+    def progresso(feitas, total, segundos):
+        barra.progress(min(feitas / total, 1.0) if total else 1.0, text=f"{feitas} de ~{total} linhas processadas ({feitas / max(segundos, 1e-9):.0f} linhas/s)")
+    if perfil and backend.eh_extrato_texto(arquivo.name):
+        return backend.ler_extrato_em_lotes(arquivo, perfil, progresso)
+    return backend.ler_planilha_em_lotes(arquivo, progresso)
+
+def processar_uploads(arquivos, processador, obrigatorias=(), perfil=None):
+    # Um único arquivo segue em lotes com progresso; vários arquivos ou ZIP são lidos em paralelo e gravados numa transação só
+    if len(arquivos) == 1 and not arquivos[0].name.lower().endswith('.zip'):
+        return processador(ler_upload(arquivos[0], perfil))
+    return backend.processar_varios_arquivos(processador, arquivos, obrigatorias, perfil)
+
+def exibir_historico_importacoes(chave):
+    # Linhas de conciliação/cancelamento já aplicadas: reenvios dessas linhas são pulados ("Já Importado")
+    with st.expander("📜 Histórico de Importações (qual arquivo baixou ou cancelou cada parcela)"):
+        busca = st.text_input("Buscar por ID do lançamento/venda ou nome do arquivo", key=f'hist_{chave}')
+        st.dataframe(backend.consultar_historico_importacoes(busca.strip()), use_container_width=True, hide_index=True)
+
 # =========================================================================
 # FUNÇÃO PRINCIPAL E SIDEBAR
 # =========================================================================
@@ -152,12 +182,6 @@ def main():
     st.title("💰 Sistema de Gestão Financeira e Comissões")
     st.write("") # Espaçamento
     
-    # Carrega DF e garante a estrutura mesmo se vazio
-    df = backend.carregar_dados()
-    if df.empty:
-        cols = ['ID_Lancamento','ID_Vendedor','ID_Gerente','Data_Previsao','Status_Recebimento','Valor_Cliente','Receber_Administradora','Liquido_Caixa','Status_Pgto_Cliente','Cliente','Vendedor','Gerente','Pagar_Vendedor','Pagar_Gerente','Administradora','Status_Pgto_Vendedor','Status_Pgto_Gerente']
-        df = pd.DataFrame(columns=cols)
-
     # =========================================================================
     # CONFIGURAÇÃO DE ACESSO ÀS ABAS (DINÂMICO)
     # =========================================================================
@@ -181,6 +205,24 @@ def main():
         "💸 Comissões":         ['Master', 'Administrativo', 'Financeiro']
     }
 
+    # Dados que cada aba consome: conjunto -> colunas (None = todas).
+    # Nada é carregado antes da aba acessar, e só a aba selecionada é renderizada.
+    # (Dashboard e Minhas Propostas consultam o backend já filtrado por usuário)
+    DADOS_ABAS = {
+        "💡 Simulador":         {'usuarios': None},
+        "⏳ Aprovações":        {'aprovacoes': None},
+        "👥 Usuários":          {'usuarios': None},
+        "⚙️ Regras":            {'regras': None},
+        "📇 Clientes":          {'clientes': None, 'ledger': ['ID_Lancamento', 'Cliente', 'ID_Vendedor', 'ID_Gerente', 'Grupo', 'Cota', 'Parcela', 'Data_Previsao',
+                                                              'Valor_Cliente', 'Receber_Administradora', 'Status_Pgto_Cliente', 'Status_Recebimento']},
+        "🛠️ Ajustes":           {'ledger': None, 'clientes': None, 'regras': None, 'usuarios': None, 'aprovacoes': None},
+        "📄 Parcelas Clientes": {'ledger': ['ID_Lancamento', 'Cliente', 'Vendedor', 'Grupo', 'Cota', 'Parcela', 'Data_Previsao', 'Mes_Referencia',
+                                            'Valor_Cliente', 'Status_Pgto_Cliente']},
+        "💸 Comissões":         {'ledger': ['ID_Lancamento', 'Cliente', 'Grupo', 'Cota', 'Parcela', 'Status_Recebimento',
+                                            'Vendedor', 'Pagar_Vendedor', 'Status_Pgto_Vendedor', 'Supervisor', 'Pagar_Supervisor', 'Status_Pgto_Supervisor',
+                                            'Gerente', 'Pagar_Gerente', 'Status_Pgto_Gerente']}
+    }
+
     cargo_atual = st.session_state['tipo_acesso']
     
     # Filtra apenas as abas que o usuário pode ver
@@ -202,6 +244,9 @@ def main():
 
     st.divider() # Linha de separação entre o menu e o conteúdo
 
+    # Acesso preguiçoso: cada conjunto declarado só é lido na primeira vez que a aba pedir
+    dados = backend.DadosAba(DADOS_ABAS.get(aba_selecionada, {}))
+
     # =========================================================================
     # RENDERIZAÇÃO DAS ABAS (Só entra no IF se a aba existir no mapa)
     # =========================================================================
@@ -217,43 +262,10 @@ def main():
                 st.header("🎯 Meu Painel de Vendas")
                 st.info("Acompanhe suas comissões, identifique suas vendas diretas vs. gerência e exporte seus relatórios.")
 
-            # Prepara filtros e limpezas
-            df['Vendedor'] = df['Vendedor'].fillna('').astype(str)
-            df['Supervisor'] = df.get('Supervisor', pd.Series([''] * len(df))).fillna('').astype(str)
-            df['Gerente'] = df['Gerente'].fillna('').astype(str)
-            df['Cliente'] = df['Cliente'].fillna('').astype(str)
-            df['Administradora'] = df['Administradora'].fillna('').astype(str)
-            
-            df['ID_Vendedor'] = df['ID_Vendedor'].fillna('0').astype(str).str.replace('.0','', regex=False)
-            df['ID_Supervisor'] = df.get('ID_Supervisor', pd.Series(['0'] * len(df))).fillna('0').astype(str).str.replace('.0','', regex=False)
-            df['ID_Gerente'] = df['ID_Gerente'].fillna('0').astype(str).str.replace('.0','', regex=False)
-            df['Data_Previsao'] = pd.to_datetime(df['Data_Previsao'], errors='coerce')
-            df['Mes_Referencia'] = df['Data_Previsao'].dt.strftime('%m/%Y')
-
-            # Previne erros de NA nos filtros de status
-            for col_st in ['Status_Recebimento', 'Status_Pgto_Cliente', 'Status_Pgto_Vendedor', 'Status_Pgto_Supervisor', 'Status_Pgto_Gerente']:
-                if col_st in df.columns:
-                    df[col_st] = df[col_st].fillna('Pendente').astype(str)
-
             meu_id = st.session_state['id_usuario']
-            dfv = df.copy()
             
-            # Row Level Security (Segurança por Linha agora inclui Supervisor)
-            if cargo_atual not in ['Master', 'Administrativo', 'Financeiro']:
-                dfv = dfv[(dfv['ID_Vendedor'] == meu_id) | (dfv['ID_Supervisor'] == meu_id) | (dfv['ID_Gerente'] == meu_id)]
-                
-            # Calcula a métrica principal de visualização
-            dfv['Minha_Comissao'] = 0.0
-            if cargo_atual in ['Master', 'Administrativo', 'Financeiro']:
-                dfv['Minha_Comissao'] = dfv['Liquido_Caixa']
-            else:
-                m_v = dfv['ID_Vendedor'] == meu_id
-                m_s = dfv['ID_Supervisor'] == meu_id
-                m_g = dfv['ID_Gerente'] == meu_id
-                if 'Pagar_Vendedor' in dfv: dfv.loc[m_v, 'Minha_Comissao'] += dfv.loc[m_v, 'Pagar_Vendedor']
-                if 'Pagar_Supervisor' in dfv: dfv.loc[m_s, 'Minha_Comissao'] += dfv.loc[m_s, 'Pagar_Supervisor']
-                if 'Pagar_Gerente' in dfv: dfv.loc[m_g, 'Minha_Comissao'] += dfv.loc[m_g, 'Pagar_Gerente']
-                dfv = dfv[dfv['Minha_Comissao'] != 0]
+            # Opções dos filtros já vêm do banco limitadas ao que o usuário pode ver
+            opcoes = backend.opcoes_filtros_dashboard(cargo_atual, meu_id)
 
             # --- FILTROS AVANÇADOS ---
             with st.expander("🔍 Filtros do Painel", expanded=False):
@@ -261,45 +273,46 @@ def main():
                 
                 # Primeira linha de filtros
                 c1, c2, c3 = st.columns(3)
-                f_mes = c1.multiselect("Mês Vencimento", sorted(dfv['Mes_Referencia'].dropna().unique()))
-                f_adm = c2.multiselect("Administradora", sorted(dfv['Administradora'].unique()))
-                f_cli = c3.multiselect("Cliente", sorted(dfv['Cliente'].unique()))
+                f_mes = c1.multiselect("Mês Vencimento", opcoes['Mes_Referencia'])
+                f_adm = c2.multiselect("Administradora", opcoes['Administradora'])
+                f_cli = c3.multiselect("Cliente", opcoes['Cliente'])
                 
                 # Segunda linha de filtros (Hierarquia)
                 c4, c5, c6 = st.columns(3)
-                f_vend = c4.multiselect("Vendedor", sorted(dfv['Vendedor'].unique()))
-                f_sup = c5.multiselect("Supervisor", sorted(dfv['Supervisor'].unique()))
-                f_ger = c6.multiselect("Gerente", sorted(dfv['Gerente'].unique()))
+                f_vend = c4.multiselect("Vendedor", opcoes['Vendedor'])
+                f_sup = c5.multiselect("Supervisor", opcoes['Supervisor'])
+                f_ger = c6.multiselect("Gerente", opcoes['Gerente'])
                 
                 st.markdown("**Filtros de Status (Pagamentos e Recebimentos)**")
                 c7, c8, c9, c10, c11 = st.columns(5)
-                f_stat_adm = c7.multiselect("Admin (FPR)", sorted(dfv['Status_Recebimento'].unique()), help="Status de Recebimento da FPR")
-                f_stat_cli = c8.multiselect("Cliente (Boleto)", sorted(dfv['Status_Pgto_Cliente'].unique()), help="Status do boleto do cliente")
-                
-                # Filtros de Comissões dinâmicos
-                f_stat_vend = []
-                f_stat_sup = []
-                f_stat_ger = []
-                
-                if 'Status_Pgto_Vendedor' in dfv.columns:
-                    f_stat_vend = c9.multiselect("Repasse Vend.", sorted(dfv['Status_Pgto_Vendedor'].unique()), help="Status de pagamento da comissão do Vendedor")
-                if 'Status_Pgto_Supervisor' in dfv.columns:
-                    f_stat_sup = c10.multiselect("Repasse Sup.", sorted(dfv['Status_Pgto_Supervisor'].unique()), help="Status de pagamento do bônus do Supervisor")
-                if 'Status_Pgto_Gerente' in dfv.columns:
-                    f_stat_ger = c11.multiselect("Repasse Ger.", sorted(dfv['Status_Pgto_Gerente'].unique()), help="Status de pagamento do bônus do Gerente")
+                f_stat_adm = c7.multiselect("Admin (FPR)", opcoes['Status_Recebimento'], help="Status de Recebimento da FPR")
+                f_stat_cli = c8.multiselect("Cliente (Boleto)", opcoes['Status_Pgto_Cliente'], help="Status do boleto do cliente")
+                f_stat_vend = c9.multiselect("Repasse Vend.", opcoes['Status_Pgto_Vendedor'], help="Status de pagamento da comissão do Vendedor")
+                f_stat_sup = c10.multiselect("Repasse Sup.", opcoes['Status_Pgto_Supervisor'], help="Status de pagamento do bônus do Supervisor")
+                f_stat_ger = c11.multiselect("Repasse Ger.", opcoes['Status_Pgto_Gerente'], help="Status de pagamento do bônus do Gerente")
+            
+            # Row Level Security (Vendedor/Supervisor/Gerente) e filtros são aplicados no próprio SQL:
+            # o banco devolve só as linhas que este usuário vai ver
+            dfv = backend.consultar_lancamentos(cargo_atual, meu_id, {
+                'Mes_Referencia': f_mes, 'Administradora': f_adm, 'Cliente': f_cli,
+                'Vendedor': f_vend, 'Supervisor': f_sup, 'Gerente': f_ger,
+                'Status_Recebimento': f_stat_adm, 'Status_Pgto_Cliente': f_stat_cli,
+                'Status_Pgto_Vendedor': f_stat_vend, 'Status_Pgto_Supervisor': f_stat_sup, 'Status_Pgto_Gerente': f_stat_ger
+            })
+
+            # Nomes, IDs, datas e status já chegam normalizados do backend (uma vez por carga)
                 
-            # Aplica todos os filtros ao DataFrame
-            if f_mes: dfv = dfv[dfv['Mes_Referencia'].isin(f_mes)]
-            if f_adm: dfv = dfv[dfv['Administradora'].isin(f_adm)]
-            if f_cli: dfv = dfv[dfv['Cliente'].isin(f_cli)]
-            if f_vend: dfv = dfv[dfv['Vendedor'].isin(f_vend)]
-            if f_sup: dfv = dfv[dfv['Supervisor'].isin(f_sup)]
-            if f_ger: dfv = dfv[dfv['Gerente'].isin(f_ger)]
-            if f_stat_adm: dfv = dfv[dfv['Status_Recebimento'].isin(f_stat_adm)]
-            if f_stat_cli: dfv = dfv[dfv['Status_Pgto_Cliente'].isin(f_stat_cli)]
-            if f_stat_vend: dfv = dfv[dfv['Status_Pgto_Vendedor'].isin(f_stat_vend)]
-            if f_stat_sup: dfv = dfv[dfv['Status_Pgto_Supervisor'].isin(f_stat_sup)]
-            if f_stat_ger: dfv = dfv[dfv['Status_Pgto_Gerente'].isin(f_stat_ger)]
+            # Calcula a métrica principal de visualização
+            dfv['Minha_Comissao'] = 0.0
+            if cargo_atual in ['Master', 'Administrativo', 'Financeiro']:
+                dfv['Minha_Comissao'] = dfv['Liquido_Caixa']
+            else:
+                m_v = dfv['ID_Vendedor'] == meu_id
+                m_s = dfv['ID_Supervisor'] == meu_id
+                m_g = dfv['ID_Gerente'] == meu_id
+                dfv.loc[m_v, 'Minha_Comissao'] += dfv.loc[m_v, 'Pagar_Vendedor']
+                dfv.loc[m_s, 'Minha_Comissao'] += dfv.loc[m_s, 'Pagar_Supervisor']
+                dfv.loc[m_g, 'Minha_Comissao'] += dfv.loc[m_g, 'Pagar_Gerente']
             
             # --- MÉTRICAS (KPIs) ---
             st.markdown("### 💰 Resumo Financeiro")
@@ -330,19 +343,17 @@ def main():
                 
                 with g1:
                     st.caption("Evolução Mensal (Líquido/Comissão)")
-                    df_grafico = dfv.dropna(subset=['Data_Previsao']).copy()
+                    df_grafico = dfv.dropna(subset=['Data_Previsao'])
                     if not df_grafico.empty:
-                        df_grafico['Ano_Mes_Sort'] = df_grafico['Data_Previsao'].dt.strftime('%Y-%m') 
-                        df_grafico['Mes_Label'] = df_grafico['Data_Previsao'].dt.strftime('%m/%Y')
-                        
-                        df_agg = df_grafico.groupby(['Ano_Mes_Sort', 'Mes_Label'], as_index=False)['Minha_Comissao'].sum()
-                        df_agg = df_agg.sort_values('Ano_Mes_Sort')
+                        # Chaves de mês já vêm calculadas no snapshot
+                        df_agg = df_grafico.groupby(['Ano_Mes', 'Mes_Referencia'], as_index=False, observed=True)['Minha_Comissao'].sum()
+                        df_agg = df_agg.sort_values('Ano_Mes').astype({'Mes_Referencia': str})
                         
                         df_agg['Texto'] = df_agg['Minha_Comissao'].apply(lambda x: f"R$ {x:,.2f}".replace(',','X').replace('.',',').replace('X','.'))
                         
                         fig1 = px.bar(
-                            df_agg, x='Mes_Label', y='Minha_Comissao', text='Texto',
-                            labels={'Mes_Label': '', 'Minha_Comissao': 'Valor (R$)'},
+                            df_agg, x='Mes_Referencia', y='Minha_Comissao', text='Texto',
+                            labels={'Mes_Referencia': '', 'Minha_Comissao': 'Valor (R$)'},
                             color_discrete_sequence=['#ff4b4b']
                         )
                         fig1.update_traces(textposition='outside', cliponaxis=False)
@@ -354,7 +365,7 @@ def main():
                 with g2:
                     if 'Administradora' in dfv.columns:
                         st.caption("Participação por Administradora")
-                        df_adm = dfv.groupby('Administradora', as_index=False)['Minha_Comissao'].sum()
+                        df_adm = dfv.groupby('Administradora', as_index=False, observed=True)['Minha_Comissao'].sum()
                         df_adm = df_adm[df_adm['Minha_Comissao'] > 0] 
                         
                         if not df_adm.empty:
@@ -378,7 +389,7 @@ def main():
                     st.caption(titulo_ranking)
                     
                     # Agrupa a comissão por vendedor, tirando os vazios
-                    df_top = dfv.groupby('Vendedor', as_index=False)['Minha_Comissao'].sum()
+                    df_top = dfv.groupby('Vendedor', as_index=False, observed=True)['Minha_Comissao'].sum()
                     df_top = df_top[(df_top['Minha_Comissao'] > 0) & (df_top['Vendedor'] != '')]
                     
                     # Pega apenas os 5 melhores e ordena para o gráfico horizontal ficar do maior pro menor
@@ -411,8 +422,6 @@ def main():
             st.divider()
             
             # --- TABELA DE DADOS RESUMIDA ---
-            dft = dfv.copy()
-            
             # --- VISÃO: COLUNAS TÉCNICAS E TODOS OS VALORES PARA A OPERAÇÃO ---
             if cargo_atual in ['Master', 'Administrativo', 'Financeiro']:
                 cols_view = [
@@ -431,10 +440,10 @@ def main():
                 ]
             
             # Garante que as colunas existem
-            cols_finais = [c for c in cols_view if c in dft.columns]
+            cols_finais = [c for c in cols_view if c in dfv.columns]
             
             # Ordenação Crescente: Parcela 1/12 antes de 2/12, etc. (Mais antigas no topo)
-            df_ordenado = dft[cols_finais].sort_values('Data_Previsao', ascending=True)
+            df_ordenado = dfv[cols_finais].sort_values('Data_Previsao', ascending=True)
             
             # Título e Botão de Exportação Universal
             col_tit, col_btn = st.columns([4, 1])
@@ -538,23 +547,39 @@ def main():
                 )
 
             with c_up:
-                up = st.file_uploader("Upload Planilha de Vendas", type=['xlsx'], key='up_entuba')
+                up = st.file_uploader("Upload Planilhas de Vendas (uma ou várias, ou um .zip)", type=['xlsx', 'zip'], key='up_entuba', accept_multiple_files=True)
+                simular = st.checkbox("🔍 Apenas validar (simulação: nada é gravado)", key='sim_entuba')
+                em_blocos = st.checkbox(f"🧱 Gravar em blocos de {backend.TAMANHO_BLOCO_COMMIT} vendas (arquivos grandes: se falhar, reenvie o mesmo arquivo para retomar)", key='blocos_entuba', disabled=simular)
                 
                 if up and st.button("🚀 Processar Arquivo (Entuba)", type="primary"):
                     with st.spinner("Analisando vendas, validando regras e gerando parcelas financeiras..."):
-                        ok, ig, logs = backend.processar_vendas_upload(pd.read_excel(up))
+                        if simular:
+                            ok, ig, previa, logs = processar_uploads(up, lambda p: backend.processar_vendas_upload(p, simular=True))
+                        elif em_blocos:
+                            chave = backend.chave_upload(*[a.getvalue() for a in up])
+                            ok, ig, logs = processar_uploads(up, lambda p: backend.processar_vendas_upload(p, commit_a_cada=backend.TAMANHO_BLOCO_COMMIT, chave=chave))
+                        else:
+                            ok, ig, logs = processar_uploads(up, backend.processar_vendas_upload)
                     
                     # Resumo do Processamento
                     st.divider()
                     col_res1, col_res2 = st.columns(2)
                     
                     if ok > 0:
-                        col_res1.success(f"✅ Sucesso: {ok} parcelas financeiras foram geradas.")
+                        col_res1.success(f"✅ {'Simulação' if simular else 'Sucesso'}: {ok} parcelas financeiras {'seriam geradas' if simular else 'foram geradas'}.")
                     else:
-                        col_res1.warning("⚠️ Nenhuma parcela nova foi gerada. Verifique os erros no relatório.")
+                        col_res1.warning("⚠️ Nenhuma parcela nova seria gerada. Verifique os erros no relatório." if simular else "⚠️ Nenhuma parcela nova foi gerada. Verifique os erros no relatório.")
                         
                     if ig > 0:
-                        col_res2.info(f"⚠️ {ig} parcelas foram ignoradas (pois já existiam no banco).")
+                        col_res2.info(f"⚠️ {ig} parcelas {'seriam ignoradas' if simular else 'foram ignoradas'} (pois já existiam no banco).")
+                    
+                    if simular and not previa.empty:
+                        # Totais do que seria gravado: permite conferir a planilha antes do processamento real
+                        m1, m2, m3, m4 = st.columns(4)
+                        m1.metric("Parcelas Previstas", len(previa))
+                        m2.metric("Receber Administradora", f"R$ {previa['Receber_Administradora'].sum():,.2f}")
+                        m3.metric("Comissões", f"R$ {previa[['Pagar_Vendedor', 'Pagar_Supervisor', 'Pagar_Gerente']].sum().sum():,.2f}")
+                        m4.metric("Líquido Caixa", f"R$ {previa['Liquido_Caixa'].sum():,.2f}")
                     
                     if not logs.empty:
                         # --- Título e Botão de Exportação lado a lado ---
@@ -603,7 +628,7 @@ def main():
             with c_info:
                 st.markdown("""
                 **Instruções do Extrato:**
-                O arquivo Excel precisa ter as colunas abaixo:
+                O arquivo Excel (ou CSV/TXT, lido pelo perfil da administradora) precisa ter as colunas abaixo:
                 * **`Grupo`** e **`Cota`** (Obrigatórios).
                 * **`Valor_Pago`** (Obrigatório - O sistema verificará se bate com a comissão esperada).
                 * `Num_Parcela` (Opcional - Ajuda o sistema a encontrar a parcela exata).
@@ -614,11 +639,14 @@ def main():
                 """)
                 
             with c_up:
-                up = st.file_uploader("Upload do Extrato da Administradora", type=['xlsx'], key='conc')
+                up = st.file_uploader("Upload dos Extratos das Administradoras (um ou vários, ou um .zip)", type=['xlsx', 'csv', 'txt', 'zip'], key='conc', accept_multiple_files=True)
+                perfil = st.selectbox("Perfil do extrato (arquivos .csv / .txt)", list(backend.PERFIS_EXTRATO), key='perfil_conc',
+                                      help="Define separador, decimal e qual coluna (ou posição, na largura fixa) corresponde a Grupo, Cota, Valor_Pago e Num_Parcela. Novos perfis vão em PERFIS_EXTRATO no secrets.toml.")
+                reprocessar = st.checkbox("♻️ Reprocessar linhas já importadas", key='reproc_conc', help="Sem marcar, linhas já aplicadas por um upload anterior são puladas sem consultar o financeiro.")
                 
                 if up and st.button("🚀 Processar Conciliação Automática", type="primary"):
                     with st.spinner("Cruzando dados do extrato com os lançamentos financeiros pendentes..."):
-                        b, logs = backend.processar_conciliacao_upload(pd.read_excel(up))
+                        b, logs = processar_uploads(up, lambda p: backend.processar_conciliacao_upload(p, reprocessar=reprocessar), backend.COLS_CONCILIACAO, perfil)
                         
                     st.divider()
                     
@@ -657,7 +685,7 @@ def main():
                             val_str = str(val).lower()
                             if 'sucesso' in val_str: color = 'green'
                             elif 'divergência' in val_str or 'erro' in val_str or 'não encontrado' in val_str: color = 'red'
-                            elif 'já baixado' in val_str or 'aviso' in val_str: color = 'orange'
+                            elif 'já baixado' in val_str or 'já importado' in val_str or 'aviso' in val_str: color = 'orange'
                             return f'color: {color}; font-weight: bold'
 
                         # Renderiza a tabela
@@ -668,6 +696,8 @@ def main():
                             hide_index=True
                         )
 
+            exibir_historico_importacoes('conc')
+
     # --- ABA: CANCELAMENTOS ---
     if aba_selecionada == "❌ Cancelamentos":
         with st.container():
@@ -691,12 +721,16 @@ def main():
                 
             with c_up:
                 up = st.file_uploader("Upload Planilha de Cancelamentos", type=['xlsx'], key='canc')
+                simular = st.checkbox("🔍 Apenas validar (simulação: nada é gravado)", key='sim_canc')
+                reprocessar = st.checkbox("♻️ Reprocessar linhas já importadas", key='reproc_canc', help="Sem marcar, linhas já aplicadas por um upload anterior são puladas sem consultar o financeiro.")
                 
                 if up and st.button("🚀 Processar Cancelamentos", type="primary"):
                     with st.spinner("Analisando parcelas e calculando regras de estorno..."):
-                        c, logs = backend.processar_cancelamento_inteligente(pd.read_excel(up))
+                        c, logs = backend.processar_cancelamento_inteligente(ler_upload(up), simular=simular, reprocessar=reprocessar)
                         
-                    if c > 0:
+                    if c > 0 and simular:
+                        st.info(f"🔍 Simulação: {c} vendas seriam canceladas. Nada foi gravado.")
+                    elif c > 0:
                         st.success(f"✅ Sucesso: {c} vendas tiveram o cancelamento processado com sucesso.")
                     else:
                         st.warning("⚠️ Nenhuma venda foi cancelada. Verifique os avisos no relatório abaixo.")
@@ -730,7 +764,7 @@ def main():
                             val_str = str(val).lower()
                             if 'sucesso' in val_str: color = 'green'
                             elif 'erro' in val_str or 'falha' in val_str: color = 'red'
-                            elif 'ignorado' in val_str or 'aviso' in val_str: color = 'orange'
+                            elif 'ignorado' in val_str or 'importado' in val_str or 'aviso' in val_str: color = 'orange'
                             return f'color: {color}; font-weight: bold'
 
                         st.dataframe(
@@ -739,6 +773,8 @@ def main():
                             hide_index=True
                         )
 
+            exibir_historico_importacoes('canc')
+
     # --- ABA: USUÁRIOS ---
     if aba_selecionada == "👥 Usuários":
         with st.container():
@@ -747,7 +783,7 @@ def main():
             
             # Divide a tela: 60% para a lista, 40% para as ações
             cl, cf = st.columns([1.5, 1])
-            dfu = backend.carregar_usuarios_df()
+            dfu = dados['usuarios']
             
             with cl:
                 st.subheader("📋 Equipe Cadastrada")
@@ -910,13 +946,16 @@ def main():
             st.header("⚙️ Catálogo de Produtos e Regras")
             st.info("Cadastre e gerencie os produtos de consórcio, parâmetros técnicos e réguas de comissionamento.")
             
-            dfr = backend.carregar_regras_df()
+            dfr = dados['regras']
             
             # Divide a tela entre Visualização e Ação (Cadastro/Edição)
             tab_lista, tab_form = st.tabs(["📋 Produtos Cadastrados", "📝 Adicionar ou Editar Regra"])
             
             # --- SUB-ABA: LISTA DE PRODUTOS ---
             with tab_lista:
+                invalidas = backend.carregar_regras().invalidas
+                if invalidas:
+                    st.warning("⚠️ Regras com campos inválidos (fora do Entuba, Cancelamentos e Simulador até serem corrigidas): " + "; ".join(f"**{t}** ({m})" for t, m in invalidas.items()))
                 if not dfr.empty:
                     st.dataframe(
                         dfr,
@@ -1035,17 +1074,14 @@ def main():
             st.info("Consulte o histórico de parcelas, atualize contatos e acompanhe a inadimplência da sua carteira.")
             
             # Carrega dados
-            dfc = backend.carregar_clientes()
-            dfv = backend.carregar_dados()
+            dfc = dados['clientes']
+            dfv = dados['ledger']
             
             # Variáveis de sessão para facilitar
             meu_id = str(st.session_state['id_usuario']).strip()
             cargo = st.session_state['tipo_acesso']
 
-            # 1. PREPARAÇÃO DOS DADOS FINANCEIROS (Normalização de IDs)
-            if not dfv.empty:
-                dfv['ID_Vendedor'] = dfv['ID_Vendedor'].fillna('0').astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
-                dfv['ID_Gerente'] = dfv['ID_Gerente'].fillna('0').astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
+            # 1. IDs já chegam normalizados do backend (comparáveis direto com meu_id)
 
             # 2. SEGURANÇA NA LISTA DE SELEÇÃO (ESQUERDA)
             # Se não for Master/Admin, filtra a lista de clientes para mostrar apenas os meus
@@ -1089,7 +1125,7 @@ def main():
             with c2:
                 if sel:
                     # A. Filtra pelo Cliente selecionado
-                    dff = dfv[dfv['Cliente'] == sel].copy()
+                    dff = dfv[dfv['Cliente'] == sel]
                     
                     # B. SEGURANÇA NA TABELA (Filtra apenas minhas parcelas)
                     if cargo not in ['Master', 'Administrativo']:
@@ -1164,12 +1200,15 @@ def main():
                 
                 with c_up:
                     up = st.file_uploader("Planilha de Correção", type=['xlsx'], key='adj')
+                    simular = st.checkbox("🔍 Apenas validar (simulação: nada é gravado)", key='sim_adj')
                     
                     if up and st.button("Executar Edição em Lote", type="primary"):
                         with st.spinner("Processando edições..."):
-                            q, log = backend.processar_edicao_lote(pd.read_excel(up))
+                            q, log = backend.processar_edicao_lote(ler_upload(up), simular=simular)
                         
-                        if q > 0:
+                        if q > 0 and simular:
+                            st.info(f"🔍 Simulação: {q} registros seriam alterados. Nada foi gravado.")
+                        elif q > 0:
                             st.success(f"✅ Sucesso: {q} registros foram alterados no banco de dados.")
                         else:
                             st.warning("⚠️ Nenhuma alteração foi realizada. Verifique os logs.")
@@ -1213,7 +1252,7 @@ def main():
                     
                     if upd and st.button("🔥 Confirmar Exclusão Definitiva", type="primary"):
                         with st.spinner("Removendo registros..."):
-                            q, log = backend.processar_exclusao_lote(pd.read_excel(upd))
+                            q, log = backend.processar_exclusao_lote(ler_upload(upd))
                             
                         if q > 0:
                             st.success(f"✅ Sucesso: {q} registros foram excluídos permanentemente.")
@@ -1267,11 +1306,11 @@ def main():
                             buffer_bkp = io.BytesIO()
                             with pd.ExcelWriter(buffer_bkp, engine='openpyxl') as writer:
                                 # Chama as funções nativas do seu backend para pegar as tabelas
-                                backend.carregar_dados().to_excel(writer, index=False, sheet_name='Financeiro')
-                                backend.carregar_clientes().to_excel(writer, index=False, sheet_name='Clientes')
-                                backend.carregar_regras_df().to_excel(writer, index=False, sheet_name='Regras')
-                                backend.carregar_usuarios_df().to_excel(writer, index=False, sheet_name='Usuarios')
-                                backend.carregar_aprovacoes_pendentes().to_excel(writer, index=False, sheet_name='Usuarios')
+                                dados['ledger'].drop(columns=backend.COLS_DERIVADAS, errors='ignore').to_excel(writer, index=False, sheet_name='Financeiro')
+                                dados['clientes'].to_excel(writer, index=False, sheet_name='Clientes')
+                                dados['regras'].to_excel(writer, index=False, sheet_name='Regras')
+                                dados['usuarios'].to_excel(writer, index=False, sheet_name='Usuarios')
+                                dados['aprovacoes'].to_excel(writer, index=False, sheet_name='Usuarios')
                             
                             # Salva o arquivo na sessão para liberar o botão de download
                             st.session_state['arquivo_backup'] = buffer_bkp.getvalue()
@@ -1296,7 +1335,7 @@ def main():
             st.header("📄 Controle de Parcelas dos Clientes")
             st.info("Filtre, selecione e atualize o status dos pagamentos realizados pelos clientes.")
             
-            dfa = backend.carregar_dados()
+            dfa = dados['ledger']
             
             # --- 1. FILTROS ---
             c1, c2, c3, c4 = st.columns(4)
@@ -1304,19 +1343,16 @@ def main():
             
             # Prepara a base conforme o status
             t = 'Pago' if m == 'Pago' else 'Pendente'
-            df_view = dfa[dfa['Status_Pgto_Cliente'] == t].copy()
+            df_view = dfa[dfa['Status_Pgto_Cliente'] == t]
             
             if not df_view.empty:
-                # Garante formato de data e cria coluna de Mês/Ano para facilitar o filtro
-                df_view['Data_Previsao'] = pd.to_datetime(df_view['Data_Previsao'], errors='coerce')
-                df_view['Mes_Venc'] = df_view['Data_Previsao'].dt.strftime('%m/%Y')
-                
-                f_mes = c2.multiselect("Mês Vencimento", sorted(df_view['Mes_Venc'].dropna().unique()), key="sel_mes_parc")
+                # Data e Mês/Ano (Mes_Referencia) já vêm prontos do snapshot
+                f_mes = c2.multiselect("Mês Vencimento", sorted(df_view['Mes_Referencia'].dropna().unique()), key="sel_mes_parc")
                 f_cli = c3.multiselect("Cliente", sorted(df_view['Cliente'].dropna().unique()), key="sel_cli_parc")
                 f_vend = c4.multiselect("Vendedor", sorted(df_view['Vendedor'].dropna().unique()), key="sel_vend_parc")
                 
                 # Aplica os filtros escolhidos
-                if f_mes: df_view = df_view[df_view['Mes_Venc'].isin(f_mes)]
+                if f_mes: df_view = df_view[df_view['Mes_Referencia'].isin(f_mes)]
                 if f_cli: df_view = df_view[df_view['Cliente'].isin(f_cli)]
                 if f_vend: df_view = df_view[df_view['Vendedor'].isin(f_vend)]
             
@@ -1418,7 +1454,7 @@ def main():
             # Checkbox mais claro: só mostra o que a empresa já recebeu
             liberados = c_chk.checkbox("Mostrar apenas liberadas (Onde a FPR já recebeu a comissão da Admin)", value=True, key='chk_liberados')
             
-            dfa = backend.carregar_dados()
+            dfa = dados['ledger']
             t = 'Pago' if m == 'Pago' else 'Pendente'
             
             rows = []
@@ -1528,10 +1564,10 @@ def main():
             st.header("💡 Simulador de Propostas")
             st.info("Utilize esta calculadora para montar cenários para seus clientes, respeitando os limites e regras do seu catálogo de consórcios.")
             
-            # Carrega o DataFrame de regras
-            dfr = backend.carregar_regras_df()
+            # Catálogo compilado (percentuais já convertidos, índice por administradora)
+            regras = backend.carregar_regras()
             
-            if dfr.empty:
+            if not regras:
                 st.warning("⚠️ O catálogo de regras está vazio. O setor Administrativo precisa cadastrar as regras na aba '⚙️ Regras' primeiro.")
             else:
                 c_form, c_result = st.columns([1, 1.5])
@@ -1540,41 +1576,40 @@ def main():
                     st.markdown("### 🛠️ Configuração do Plano")
                     
                     # 1. Filtro de Administradora (Para organizar se a lista ficar grande)
-                    lista_adms = sorted(dfr['administradora'].unique())
+                    lista_adms = sorted(regras.por_administradora)
                     adm_sel = st.selectbox("1. Administradora", lista_adms)
                     
                     # 2. Filtro de Produto
-                    dfr_filtrado = dfr[dfr['administradora'] == adm_sel]
-                    produto_sel = st.selectbox("2. Produto (Tipo de Cota)", sorted(dfr_filtrado['tipo_cota'].unique()))
+                    produto_sel = st.selectbox("2. Produto (Tipo de Cota)", sorted(r.tipo_cota for r in regras.por_administradora[adm_sel]))
                     
                     if produto_sel:
-                        regra = dfr_filtrado[dfr_filtrado['tipo_cota'] == produto_sel].iloc[0]
+                        regra = regras.get(produto_sel)
                         
                         st.markdown("---")
                         
                         # 3. Inputs respeitando exatamente os limites do banco de dados
                         credito_escolhido = st.number_input(
-                            f"3. Valor do Crédito (Mín: R$ {regra['min_credito']:,.0f} | Máx: R$ {regra['max_credito']:,.0f})",
-                            min_value=float(regra['min_credito']),
-                            max_value=float(regra['max_credito']),
-                            value=float(regra['min_credito']),
+                            f"3. Valor do Crédito (Mín: R$ {regra.min_credito:,.0f} | Máx: R$ {regra.max_credito:,.0f})",
+                            min_value=float(regra.min_credito),
+                            max_value=float(regra.max_credito),
+                            value=float(regra.min_credito),
                             step=5000.0,
                             format="%.2f"
                         )
                         
                         prazo_escolhido = st.number_input(
-                            f"4. Prazo em Meses (Mín: {regra['min_prazo']} | Máx: {regra['max_prazo']})",
-                            min_value=int(regra['min_prazo']),
-                            max_value=int(regra['max_prazo']),
-                            value=int(regra['max_prazo']),
+                            f"4. Prazo em Meses (Mín: {regra.min_prazo} | Máx: {regra.max_prazo})",
+                            min_value=int(regra.min_prazo),
+                            max_value=int(regra.max_prazo),
+                            value=int(regra.max_prazo),
                             step=1
                         )
                         
                         taxa_adm_escolhida = st.number_input(
-                            f"5. Taxa de Administração % (Mín: {regra['min_taxa_adm']}% | Máx: {regra['max_taxa_adm']}%)",
-                            min_value=float(regra['min_taxa_adm']),
-                            max_value=float(regra['max_taxa_adm']),
-                            value=float(regra['min_taxa_adm']),
+                            f"5. Taxa de Administração % (Mín: {regra.min_taxa_adm}% | Máx: {regra.max_taxa_adm}%)",
+                            min_value=float(regra.min_taxa_adm),
+                            max_value=float(regra.max_taxa_adm),
+                            value=float(regra.min_taxa_adm),
                             step=0.5,
                             format="%.2f"
                         )
@@ -1584,8 +1619,8 @@ def main():
                         st.markdown("### 📄 Proposta Comercial do Cliente")
                         
                         # --- MATEMÁTICA BÁSICA DO CONSÓRCIO ---
-                        fundo_res = float(regra['fundo_reserva'])
-                        taxa_antecipada = float(regra.get('taxa_antecipada', 0.0))
+                        fundo_res = regra.fundo_reserva
+                        taxa_antecipada = regra.taxa_antecipada
                         
                         # Calcula os valores monetários das taxas
                         valor_taxa_adm = credito_escolhido * (taxa_adm_escolhida / 100.0)
@@ -1615,10 +1650,10 @@ def main():
                         # Detalhamento em Expander para o vendedor tirar dúvidas rápido
                         with st.expander("🔍 Ver Detalhamento do Contrato", expanded=True):
                             cd1, cd2 = st.columns(2)
-                            cd1.write(f"**Administradora:** {regra['administradora']}")
+                            cd1.write(f"**Administradora:** {regra.administradora}")
                             cd1.write(f"**Prazo do Plano:** {prazo_escolhido} meses")
-                            cd1.write(f"**Índice Anual:** {regra['indice_reajuste']}")
-                            cd1.write(f"**Modalidades:** {regra['modalidades_contemplacao']}")
+                            cd1.write(f"**Índice Anual:** {regra.indice_reajuste}")
+                            cd1.write(f"**Modalidades:** {regra.modalidades_contemplacao}")
                             
                             cd2.write(f"**Taxa ADM:** {taxa_adm_escolhida}% (R$ {valor_taxa_adm:,.2f})")
                             cd2.write(f"**F. Reserva:** {fundo_res}% (R$ {valor_fundo_res:,.2f})")
@@ -1626,9 +1661,9 @@ def main():
                             cd2.write(f"**Total a Pagar:** R$ {total_divida:,.2f}")
                             
                             st.divider()
-                            st.caption(f"**Lance Embutido Máx:** {regra['pct_lance_embutido']}%")
-                            st.caption(f"**Regra de Taxa de Adesão:** Cobrada de forma antecipada com referência em '{regra['ref_taxa_antecipada']}'.")
-                            st.caption(f"**Estorno (Churn):** Retenção de {regra['pct_estorno']}% se o cliente cancelar até a {regra['limite_parcela_estorno']}ª parcela.")
+                            st.caption(f"**Lance Embutido Máx:** {regra.pct_lance_embutido}%")
+                            st.caption(f"**Regra de Taxa de Adesão:** Cobrada de forma antecipada com referência em '{regra.ref_taxa_antecipada}'.")
+                            st.caption(f"**Estorno (Churn):** Retenção de {regra.pct_estorno}% se o cliente cancelar até a {regra.limite_parcela_estorno}ª parcela.")
 
                         st.markdown("<br>", unsafe_allow_html=True)
                         
@@ -1640,7 +1675,7 @@ def main():
                             st.markdown("### 💰 Minha Previsão de Comissão")
                             st.info("Projeção do valor que você receberá por realizar esta venda (Taxa de Venda Direta).")
                         
-                        lista_pct = [pct.strip() for pct in str(regra['lista_percentuais']).split(',') if pct.strip()]
+                        lista_pct = regra.pcts
                         
                         if lista_pct:
                             dados_comissao = []
@@ -1649,7 +1684,7 @@ def main():
                             # --- BUSCA A TAXA DO USUÁRIO LOGADO NO BANCO ---
                             minha_taxa_pct = 0.0
                             if cargo_atual not in ['Master', 'Administrativo', 'Financeiro']:
-                                df_usuarios = backend.carregar_usuarios_df()
+                                df_usuarios = dados['usuarios']
                                 meu_id = st.session_state['id_usuario']
                                 
                                 # Verifica se o DataFrame carregou e se a coluna id_usuario existe
@@ -1661,9 +1696,8 @@ def main():
                                         # nós sempre aplicamos a 'taxa_vendedor', mesmo que ela seja Gerente!
                                         minha_taxa_pct = float(usuario_info.iloc[0].get('taxa_vendedor', 0.0))
                             
-                            for i, p in enumerate(lista_pct):
+                            for i, pct_val in enumerate(lista_pct):
                                 try:
-                                    pct_val = float(p)
                                     val_com_empresa = credito_escolhido * (pct_val / 100.0)
                                     total_comissao_empresa += val_com_empresa
                                     
@@ -1721,7 +1755,7 @@ def main():
                         meu_id_vend = st.session_state['id_usuario']
                         
                         # Tenta puxar a hierarquia dele no banco
-                        df_u_sim = backend.carregar_usuarios_df()
+                        df_u_sim = dados['usuarios']
                         meu_info = df_u_sim[df_u_sim['id_usuario'].astype(str) == str(meu_id_vend)]
                         
                         meu_sup = None
@@ -1735,7 +1769,7 @@ def main():
                             id_supervisor=meu_sup,
                             id_gerente=meu_ger,
                             cliente=nome_cli,
-                            adm=regra['administradora'],
+                            adm=regra.administradora,
                             produto=produto_sel,
                             credito=credito_escolhido,
                             prazo=prazo_escolhido,
@@ -1840,7 +1874,7 @@ def main():
                 st.divider()
 
             # --- LISTAGEM DAS VENDAS PENDENTES ---
-            df_pendentes = backend.carregar_aprovacoes_pendentes()
+            df_pendentes = dados['aprovacoes']
             
             if df_pendentes.empty:
                 st.success("🎉 Nenhuma venda pendente de aprovação no momento. A fila está limpa!")
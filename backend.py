@@ -1,13 +1,42 @@
 # backend.py
 import pandas as pd
+import numpy as np
 import streamlit as st
-from sqlalchemy import text
+from sqlalchemy import text, select, insert, update, bindparam, and_, or_, case, func, event
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import hashlib
-from database import engine, SessionLocal
-from models import Lancamento, Usuario, Cliente, RegraComissao
+import itertools
+import threading
+import json
+import time
+import logging
+import os
+import io
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from functools import lru_cache
+from dataclasses import dataclass
+import pyarrow as pa
+import pyarrow.parquet as pq
+try: import resource # Pico de memória do processo (não existe no Windows)
+except ImportError: resource = None
+from database import engine, SessionLocal, init_db, ler_revisao, ler_revisoes, revisao_da_transacao, marcar_alteracao, DATABASE_URL, INSTANCIA_BANCO
+from models import Lancamento, LancamentoExcluido, Usuario, Cliente, RegraComissao, CheckpointUpload, HistoricoImportacao
 import bcrypt
+import leitura
+from leitura import EXTENSOES_TEXTO, eh_extrato_texto, hash_arquivo
+
+# Métricas de carga/gravação e avisos dos snapshots: nível DEBUG/INFO, fora da saída padrão em produção
+logger = logging.getLogger(__name__)
+
+# Garante tabelas/colunas novas (ex: controle de revisões) uma vez por processo; chamado na partida do app, não no import
+@st.cache_resource
+def preparar_banco():
+    init_db()
 
 
 # --- MAPEAMENTO DE COLUNAS (SQL -> APP) ---
@@ -28,6 +57,13 @@ MAPA_SQL_APP = {
     'obs': 'Obs'
 }
 
+MAPA_APP_SQL = {v: k for k, v in MAPA_SQL_APP.items()}
+
+# Colunas só do banco (controle do delta e parcela estruturada, derivada do texto): fora do DataFrame do app e da edição em lote
+COLS_INTERNAS = ['revisao', 'num_parcela', 'total_parcelas', 'is_estorno']
+
+COLS_VALORES = ['Valor_Cliente', 'Valor_Recebido_Real', 'Receber_Administradora', 'Pagar_Vendedor', 'Pagar_Supervisor', 'Pagar_Gerente', 'Liquido_Caixa']
+
 def limpar_id(val):
     if pd.isna(val) or str(val).strip() == '': return None
     return str(val).strip().replace('.0', '')
@@ -52,84 +88,537 @@ def verificar_hash(senha_digitada, hash_armazenado):
     except Exception as e:
         return False
 
+# --- VERSÕES DAS TABELAS (CACHE INVALIDADO POR TABELA) ---
+# Cada leitura cacheada recebe a versão das tabelas que lê como parâmetro:
+# quando uma escrita incrementa a versão de uma tabela, só os caches que dependem dela são refeitos.
+@st.cache_data(ttl=5, show_spinner=False)
+def _ler_versoes():
+    try:
+        with engine.connect() as conn: return ler_revisoes(conn)
+    except: return {}
+
+def versao_tabela(tabela):
+    return _ler_versoes().get(tabela, 0)
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _renovar_versoes(session):
+    # Commit que alterou alguma tabela: a próxima leitura já enxerga as versões novas
+    if session.info.get('revisoes') or session.info.get('alteradas'): _ler_versoes.clear()
+
 # --- LEITURA COM LIMPEZA PARA OS FILTROS ---
-@st.cache_data(ttl=300, show_spinner=False) # Mantém na memória por 5 minutos (300 segundos)
-def carregar_dados():
+# Colunas repetitivas (poucos valores distintos) ficam como category: códigos inteiros no lugar de milhares de strings iguais.
+# O vazio recebe o mesmo valor que as abas já usavam ao exibir.
+COLS_CATEGORIA = {
+    'Administradora': '', 'Tipo_Cota': '', 'Parcela': '',
+    'Vendedor': '', 'Supervisor': '', 'Gerente': '',
+    'ID_Vendedor': '', 'ID_Supervisor': '', 'ID_Gerente': '',
+    'Status_Recebimento': '', 'Status_Pgto_Cliente': '',
+    'Status_Pgto_Vendedor': 'Pendente', 'Status_Pgto_Supervisor': 'Pendente', 'Status_Pgto_Gerente': 'Pendente',
+}
+COLS_IDS = ['ID_Vendedor', 'ID_Supervisor', 'ID_Gerente']
+COLS_DATAS = ['Data_Previsao', 'Data_Real_Recebimento']
+# Colunas calculadas uma única vez por snapshot (as abas só consomem)
+COLS_DERIVADAS = ['Mes_Referencia', 'Ano_Mes']
+
+def _texto_limpo(serie, vazio=''):
+    s = serie.fillna(vazio).astype(str).str.strip()
+    # Converte "nan" string para vazio real
+    return s.mask(s.str.lower() == 'nan', vazio)
+
+def _chave_mes(datas, formato):
+    # strftime linha a linha é lento: formata só as datas distintas e espalha pelos códigos
+    codigos, unicas = pd.factorize(datas)
+    return pd.Series(pd.Categorical(unicas.strftime(formato)).take(codigos, allow_fill=True), index=datas.index)
+
+def _limpar_ledger(df):
+    # Etapa única de normalização: roda uma vez por carga (snapshot, delta ou consulta do painel).
+    # As abas consomem o resultado pronto, sem refazer limpeza a cada rerun.
+    # Traduz nomes
+    df = df.rename(columns=MAPA_SQL_APP).drop(columns=COLS_INTERNAS, errors='ignore')
+    
+    # --- LIMPEZA CRÍTICA PARA FILTROS ---
+    # Se isso não for feito, os filtros ficam vazios ou com duplicatas sujas
+    if 'Cliente' in df.columns:
+        df['Cliente'] = _texto_limpo(df['Cliente'])
+    for col, vazio in COLS_CATEGORIA.items():
+        if col in df.columns:
+            s = _texto_limpo(df[col], vazio)
+            # IDs canônicos: '101.0' (herança do Excel) vira '101', comparável direto com o id da sessão
+            if col in COLS_IDS: s = s.str.replace(r'\.0$', '', regex=True)
+            df[col] = s.astype('category')
+
+    # Garante datas
+    for col in COLS_DATAS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+    
+    # Garante números (lote do delta com coluna toda vazia viria como object e quebraria o concat)
+    for col in COLS_VALORES:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    # Chaves de mês para filtros e gráficos ('MM/AAAA' para exibir, 'AAAA-MM' para ordenar)
+    if 'Data_Previsao' in df.columns:
+        df['Mes_Referencia'] = _chave_mes(df['Data_Previsao'], '%m/%Y')
+        df['Ano_Mes'] = _chave_mes(df['Data_Previsao'], '%Y-%m')
+        
+    return df
+
+def _juntar_ledger(*partes):
+    # concat de category com categorias diferentes vira object: une as categorias antes de juntar
+    cols_cat = [c for c in partes[0].columns if isinstance(partes[0][c].dtype, pd.CategoricalDtype)]
+    cats = {c: partes[0][c].cat.categories for c in cols_cat}
+    for p in partes[1:]:
+        for c in cols_cat:
+            if c in p.columns: cats[c] = cats[c].union(p[c].cat.categories)
+    alinhadas = [p.assign(**{c: p[c].cat.set_categories(cats[c]) for c in cols_cat if c in p.columns}) for p in partes]
+    return pd.concat(alinhadas, ignore_index=True)
+
+# --- LEITURA EM LOTES ---
+# O mysql-connector bufferiza o resultado inteiro antes do pandas montar o DataFrame (pico ~2x).
+# Lendo por faixas da chave primária (id_lancamento > último lido, LIMIT n), só um lote cru fica em memória:
+# cada lote é normalizado (categorias compactas) e o cru é descartado antes do próximo.
+TAMANHO_LOTE_LEITURA = int(st.secrets.get("LEDGER_CHUNK", os.getenv("LEDGER_CHUNK", 20000)))
+
+def _colunas_sql(colunas):
+    # Projeção pedida (nomes do app) -> colunas do SQL. id_lancamento sempre vem (chave da paginação e do delta);
+    # as chaves de mês derivadas precisam de data_previsao
+    t = Lancamento.__table__
+    if colunas is None: return list(t.c)
+    nomes = {MAPA_APP_SQL[c] for c in colunas if c in MAPA_APP_SQL} | {'id_lancamento'}
+    if set(colunas) & set(COLS_DERIVADAS): nomes.add('data_previsao')
+    return [c for c in t.c if c.name in nomes]
+
+def _ler_ledger_em_lotes(conn, *condicoes, colunas=None):
+    t = Lancamento.__table__
+    cols = _colunas_sql(colunas)
+    partes, ultimo = [], None
+    while True:
+        stmt = select(*cols).where(*condicoes).order_by(t.c.id_lancamento).limit(TAMANHO_LOTE_LEITURA)
+        if ultimo is not None: stmt = stmt.where(t.c.id_lancamento > ultimo)
+        lote = pd.read_sql(stmt, conn)
+        if lote.empty: break
+        ultimo = lote['id_lancamento'].iloc[-1]
+        partes.append(_limpar_ledger(lote))
+        if len(lote) < TAMANHO_LOTE_LEITURA: break
+    if not partes: return _limpar_ledger(pd.read_sql(select(*cols).limit(0), conn))
+    return _juntar_ledger(*partes)
+
+def _registrar_memoria(estado, origem, segundos):
+    df = estado['df']
+    estado['memoria_mb'] = df.memory_usage(deep=True).sum() / 1024 ** 2
+    # ru_maxrss vem em KB no Linux
+    pico = f", pico do processo {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB" if resource else ""
+    # Carga completa (banco/snapshot) em INFO; cada delta em DEBUG
+    logger.log(logging.DEBUG if origem == 'delta' else logging.INFO, "Ledger rev %s (%s, %.2fs): %s linhas x %s colunas, %.2f MB em memória%s",
+               estado['revisao'], origem, segundos, len(df), len(df.columns), estado['memoria_mb'], pico)
+
+# --- SNAPSHOT LOCAL EM DISCO (PARTIDA A FRIO) ---
+# Cópia colunar (Parquet) das tabelas, marcada com a revisão do banco de onde veio.
+# Processo novo abre o arquivo local e só busca no banco o que mudou depois dele.
+PASTA_SNAPSHOT = st.secrets.get("SNAPSHOT_DIR", os.getenv("SNAPSHOT_DIR", "./snapshots"))
+FORMATO_SNAPSHOT = 2 # Incrementar quando _limpar_ledger mudar o formato das colunas
+INTERVALO_SNAPSHOT = 300 # Segundos mínimos entre regravações do ledger
+
+def _identificar_banco():
+    # Snapshot de outro banco (ou do mesmo endereço recriado do zero) não serve
+    try:
+        with engine.connect() as conn: instancia = ler_revisao(conn, INSTANCIA_BANCO)
+    except Exception: instancia = 0
+    return hashlib.sha256(f"{DATABASE_URL}|{instancia}".encode()).hexdigest()[:16]
+
+_ORIGEM_SNAPSHOT = _identificar_banco()
+_snapshots_abertos = set()
+
+def _caminho_snapshot(nome):
+    return os.path.join(PASTA_SNAPSHOT, f"{nome}.parquet")
+
+def _abrir_snapshot(nome):
+    # Devolve (df, revisão) se o arquivo existir e for deste banco e formato; senão (None, None)
+    try:
+        tabela = pq.read_table(_caminho_snapshot(nome), memory_map=True)
+        meta = json.loads((tabela.schema.metadata or {}).get(b'fpr_snapshot', b'{}'))
+        if meta.get('origem') != _ORIGEM_SNAPSHOT or meta.get('formato') != FORMATO_SNAPSHOT: return None, None
+        return tabela.to_pandas(), meta['revisao']
+    except FileNotFoundError: return None, None
+    except Exception as e:
+        logger.warning("Snapshot %s ignorado: %s", nome, e)
+        return None, None
+
+_pedidos_snapshot = itertools.count(1)
+_ultimo_pedido = {}  # nome -> último pedido de gravação
+_trava_snapshot = threading.Lock()
+
+def _gravar_snapshot(nome, df, revisao, pedido):
+    # Uma gravação por vez; a que já foi superada por um pedido mais novo (ex.: DataFrame ampliado logo depois) nem grava
+    with _trava_snapshot:
+        if pedido != _ultimo_pedido.get(nome): return
+        _escrever_snapshot(nome, df, revisao)
+
+def _escrever_snapshot(nome, df, revisao):
     try:
-        # Lê do SQL
-        df = pd.read_sql("SELECT * FROM financeiro_mestre", engine)
+        os.makedirs(PASTA_SNAPSHOT, exist_ok=True)
+        tabela = pa.Table.from_pandas(df, preserve_index=False)
+        meta = dict(tabela.schema.metadata or {})
+        meta[b'fpr_snapshot'] = json.dumps({'origem': _ORIGEM_SNAPSHOT, 'formato': FORMATO_SNAPSHOT, 'revisao': revisao}).encode()
+        # Grava em arquivo temporário e troca de uma vez: leitor nunca vê arquivo pela metade
+        tmp = f"{_caminho_snapshot(nome)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pq.write_table(tabela.replace_schema_metadata(meta), tmp)
+        os.replace(tmp, _caminho_snapshot(nome))
+    except Exception as e: logger.warning("Erro gravando snapshot %s: %s", nome, e)
+
+def _salvar_snapshot(nome, df, revisao):
+    # Em segundo plano: o DataFrame é imutável, então a gravação não atrasa a tela
+    if df is None or df.empty: return
+    pedido = _ultimo_pedido[nome] = next(_pedidos_snapshot)
+    threading.Thread(target=_gravar_snapshot, args=(nome, df, revisao, pedido), daemon=True).start()
+
+def _ler_tabela(nome, versao):
+    # Primeira leitura do processo aceita o snapshot local da mesma versão; as seguintes (ttl) vão ao banco
+    if nome not in _snapshots_abertos:
+        _snapshots_abertos.add(nome)
+        df, rev = _abrir_snapshot(nome)
+        if df is not None and rev == versao: return df
+    df = pd.read_sql(f"SELECT * FROM {nome}", engine)
+    _salvar_snapshot(nome, df, versao)
+    return df
+
+# Cópia rasa só isola a visão com Copy-on-Write (padrão a partir do pandas 3); antes disso, a visão completa é cópia real
+_COPIA_RASA_ISOLA = int(pd.__version__.split('.')[0]) >= 3
+
+@st.cache_resource(show_spinner=False)
+def _estado_ledger():
+    # Estado único do processo: um DataFrame canônico com a união das colunas que as abas já pediram (None = ledger completo),
+    # marca d'água (última revisão já aplicada) e um único snapshot em disco. As abas recebem visões dele (carregar_dados)
+    return {'df': None, 'revisao': -1, 'lacunas': {}, 'conferido_em': 0.0, 'colunas': (), 'snapshot': 'financeiro_mestre', 'memoria_mb': 0.0,
+            'snapshot_rev': -1, 'snapshot_em': 0.0, 'lock': threading.Lock()}
+
+def _colunas_app(colunas):
+    # Colunas (nomes do app) que uma leitura com essa projeção entrega, já com as derivadas
+    nomes = {MAPA_SQL_APP[c.name] for c in _colunas_sql(colunas) if c.name in MAPA_SQL_APP}
+    return nomes | set(COLS_DERIVADAS) if 'Data_Previsao' in nomes else nomes
+
+def _projecao_do_frame(df):
+    # Projeção que um DataFrame já normalizado cobre (None se tiver o ledger completo)
+    cols = tuple(sorted(set(df.columns) - set(COLS_DERIVADAS)))
+    return None if _colunas_app(None) <= set(df.columns) else cols
+
+def _cobre(tem, pedidas):
+    return tem is None or (pedidas is not None and _colunas_app(pedidas) <= _colunas_app(tem))
+
+# Lacunas: revisões já abaixo da marca d'água sem nenhuma linha visível. A revisão é reservada antes do commit de quem escreve
+# (proxima_revisao), então uma transação longa pode aparecer depois de outras mais novas. Cada lacuna é reconferida a cada
+# INTERVALO_LACUNAS s, mesmo sem revisão nova no banco, até aparecer ou passar de VALIDADE_LACUNA s (transação desfeita ou vazia);
+# só as JANELA_LACUNAS mais recentes são acompanhadas.
+INTERVALO_LACUNAS = 5
+VALIDADE_LACUNA = int(st.secrets.get("SYNC_GAP_TTL", os.getenv("SYNC_GAP_TTL", 3600)))
+JANELA_LACUNAS = 500
+
+def _revisoes_visiveis(conn, cond_l, cond_e):
+    t, te = Lancamento.__table__, LancamentoExcluido.__table__
+    return (set(conn.execute(select(t.c.revisao).where(cond_l).distinct()).scalars())
+            | set(conn.execute(select(te.c.revisao).where(cond_e).distinct()).scalars()))
+
+def _sincronizar_ledger(estado):
+    inicio = time.perf_counter(); agora = time.time()
+    origem = 'delta'
+    t, te = Lancamento.__table__, LancamentoExcluido.__table__
+    df_novos = None
+    with engine.connect() as conn:
+        rev_banco = ler_revisao(conn)
         
-        # Traduz nomes
-        df = df.rename(columns=MAPA_SQL_APP)
+        # Primeira carga do processo: snapshot local (o delta abaixo completa o que mudou depois dele)
+        # ou, sem snapshot válido, leitura completa uma única vez
+        if estado['df'] is None:
+            df_snap, rev_snap = _abrir_snapshot(estado['snapshot'])
+            # Snapshot à frente do banco (banco restaurado de backup) ou sem as colunas pedidas não serve;
+            # com colunas a mais, fica com todas (outras abas deste processo provavelmente vão pedi-las)
+            if df_snap is not None and rev_snap <= rev_banco and _cobre(_projecao_do_frame(df_snap), estado['colunas']):
+                estado['colunas'] = _projecao_do_frame(df_snap)
+                estado['df'], estado['revisao'], origem = df_snap, rev_snap, 'snapshot'
+                estado['snapshot_rev'], estado['snapshot_em'] = rev_snap, time.time()
+            else:
+                estado['df'] = _ler_ledger_em_lotes(conn, colunas=estado['colunas'])
+                estado['revisao'], origem = rev_banco, 'banco'
+            # Revisões recentes podem ser de transações ainda abertas: no snapshot, todas são reconferidas;
+            # na leitura completa, só as que não vieram
+            janela = range(max(estado['revisao'] - JANELA_LACUNAS, 0) + 1, estado['revisao'] + 1)
+            vistas = set() if origem == 'snapshot' else _revisoes_visiveis(conn, t.c.revisao.in_(janela), te.c.revisao.in_(janela))
+            estado['lacunas'] = {r: agora for r in janela if r not in vistas}
         
-        # --- LIMPEZA CRÍTICA PARA FILTROS ---
-        # Se isso não for feito, os filtros ficam vazios ou com duplicatas sujas
-        cols_texto = ['Vendedor', 'Gerente', 'Cliente', 'Status_Recebimento', 'Status_Pgto_Cliente']
-        for col in cols_texto:
-            if col in df.columns:
-                df[col] = df[col].fillna('').astype(str).str.strip()
-                # Converte "nan" string para vazio real
-                df.loc[df[col].str.lower() == 'nan', col] = ''
-
-        # Garante datas
-        if 'Data_Previsao' in df.columns:
-            df['Data_Previsao'] = pd.to_datetime(df['Data_Previsao'], errors='coerce')
-            
-        return df
+        # Delta: linhas alteradas/excluídas depois da marca d'água e nas lacunas ainda dentro da validade
+        wm = estado['revisao']
+        estado['lacunas'] = {r: desde for r, desde in estado['lacunas'].items() if agora - desde < VALIDADE_LACUNA}
+        lacunas = list(estado['lacunas'])
+        if rev_banco > wm or lacunas:
+            cond_l, cond_e = t.c.revisao > wm, te.c.revisao > wm
+            if lacunas: cond_l, cond_e = or_(cond_l, t.c.revisao.in_(lacunas)), or_(cond_e, te.c.revisao.in_(lacunas))
+            vistas = _revisoes_visiveis(conn, cond_l, cond_e)
+            if vistas:
+                df_novos = _ler_ledger_em_lotes(conn, cond_l, colunas=estado['colunas'])
+                df_excl = pd.read_sql(select(te.c.id_lancamento).where(cond_e), conn)
+            novas = {r: agora for r in range(max(wm, rev_banco - JANELA_LACUNAS) + 1, rev_banco + 1)}
+            novas.update({r: estado['lacunas'][r] for r in lacunas})
+            estado['lacunas'] = dict(sorted((r, d) for r, d in novas.items() if r not in vistas)[-JANELA_LACUNAS:])
+            estado['revisao'] = max(wm, rev_banco)
+    estado['conferido_em'] = agora
+    
+    if df_novos is not None:
+        df = estado['df']
+        ids_fora = set(df_excl['id_lancamento']) | set(df_novos['ID_Lancamento'])
+        if ids_fora: df = df[~df['ID_Lancamento'].isin(ids_fora)]
+        if not df_novos.empty:
+            df = _juntar_ledger(df, df_novos)
+        estado['df'] = df
+    
+    _registrar_memoria(estado, origem, time.perf_counter() - inicio)
+    # Regrava o snapshot em disco: logo após a leitura completa (inclusive a que ampliou as colunas); depois, no máximo a cada INTERVALO_SNAPSHOT
+    if origem == 'banco' or (estado['revisao'] != estado['snapshot_rev'] and time.time() - estado['snapshot_em'] >= INTERVALO_SNAPSHOT):
+        _salvar_snapshot(estado['snapshot'], estado['df'], estado['revisao'])
+        estado['snapshot_rev'], estado['snapshot_em'] = estado['revisao'], time.time()
+
+def carregar_dados(colunas=None):
+    # colunas: projeção pedida pela aba (nomes do app; None = todas). Um único DataFrame por processo guarda a união
+    # das projeções já pedidas; aba que pede coluna nova amplia essa união (uma releitura, poucas vezes por processo)
+    if colunas is not None: colunas = tuple(sorted(set(colunas) | {'ID_Lancamento'}))
+    estado = _estado_ledger()
+    with estado['lock']:
+        try:
+            if not _cobre(estado['colunas'], colunas):
+                estado['colunas'] = None if colunas is None or estado['colunas'] is None else tuple(sorted(set(estado['colunas']) | set(colunas)))
+                estado['df'] = None
+            # Sem escrita nova no ledger (nem lacuna a reconferir): nem consulta o banco
+            if (estado['df'] is None or revisao_ledger() > estado['revisao']
+                    or (estado['lacunas'] and time.time() - estado['conferido_em'] >= INTERVALO_LACUNAS)):
+                _sincronizar_ledger(estado)
+        except Exception as e:
+            print(f"Erro leitura SQL: {e}")
+            if estado['df'] is None: return pd.DataFrame()
+        # DataFrame único do processo: nunca é alterado no lugar (cada sincronização monta um novo) nem sai daqui
+        # sem cópia. Seleção de colunas já devolve DataFrame próprio; a visão completa é cópia rasa só com Copy-on-Write
+        df = estado['df']
+        if colunas is None: return df.copy(deep=not _COPIA_RASA_ISOLA)
+        return df[[c for c in df.columns if c in _colunas_app(colunas)]]
+
+def revisao_ledger():
+    return versao_tabela('financeiro_mestre')
+
+# --- CONSULTA DO DASHBOARD (SEGURANÇA E FILTROS DIRETO NO SQL) ---
+CARGOS_GESTAO = ['Master', 'Administrativo', 'Financeiro']
+
+# Colunas que o painel usa (fora ficam obs, tipo de cota e dados de recebimento real)
+COLS_PAINEL = [
+    'ID_Lancamento', 'ID_Venda', 'Data_Previsao', 'Mes_Referencia', 'Ano_Mes', 'Administradora', 'Cliente', 'Grupo', 'Cota', 'Parcela',
+    'Valor_Cliente', 'Receber_Administradora', 'Pagar_Vendedor', 'Pagar_Supervisor', 'Pagar_Gerente', 'Liquido_Caixa',
+    'ID_Vendedor', 'Vendedor', 'ID_Supervisor', 'Supervisor', 'ID_Gerente', 'Gerente',
+    'Status_Recebimento', 'Status_Pgto_Cliente', 'Status_Pgto_Vendedor', 'Status_Pgto_Supervisor', 'Status_Pgto_Gerente'
+]
+
+# Filtro do painel -> (coluna SQL, valor que o painel exibe quando o banco tem NULL)
+FILTROS_DASHBOARD = {
+    'Administradora': ('administradora', ''), 'Cliente': ('cliente', ''),
+    'Vendedor': ('vendedor', ''), 'Supervisor': ('supervisor', ''), 'Gerente': ('gerente', ''),
+    'Status_Recebimento': ('status_recebimento', ''), 'Status_Pgto_Cliente': ('status_pgto_cliente', ''),
+    'Status_Pgto_Vendedor': ('status_pgto_vendedor', 'Pendente'), 'Status_Pgto_Supervisor': ('status_pgto_supervisor', 'Pendente'),
+    'Status_Pgto_Gerente': ('status_pgto_gerente', 'Pendente')
+}
+
+def _condicoes_rls(t, cargo, id_usuario):
+    # Diretoria vê tudo. Comercial só vê linhas onde é Vendedor/Supervisor/Gerente E tem comissão a receber
+    if cargo in CARGOS_GESTAO: return []
+    # IDs gravados sempre por limpar_id (legados corrigidos em normalizar_ids_ledger): comparação direta, pelos índices
+    meu = limpar_id(id_usuario) or ''
+    vend, sup, ger = (c == meu for c in (t.c.id_vendedor, t.c.id_supervisor, t.c.id_gerente))
+    minha_comissao = (
+        case((vend, func.coalesce(t.c.pagar_vendedor, 0)), else_=0) +
+        case((sup, func.coalesce(t.c.pagar_supervisor, 0)), else_=0) +
+        case((ger, func.coalesce(t.c.pagar_gerente, 0)), else_=0)
+    )
+    return [or_(vend, sup, ger), minha_comissao != 0]
+
+def _condicoes_filtros(t, filtros):
+    conds = []
+    for chave, valores in filtros:
+        if not valores: continue
+        if chave == 'Mes_Referencia':
+            # "MM/AAAA" vira faixa de datas para aproveitar o índice de data_previsao
+            faixas = []
+            for mes in valores:
+                m, a = str(mes).split('/')
+                ini = datetime(int(a), int(m), 1).date()
+                faixas.append(and_(t.c.data_previsao >= ini, t.c.data_previsao < ini + relativedelta(months=1)))
+            conds.append(or_(*faixas))
+        elif chave in FILTROS_DASHBOARD:
+            col, vazio = FILTROS_DASHBOARD[chave]
+            cond = t.c[col].in_(list(valores))
+            if vazio in valores: cond = or_(cond, t.c[col].is_(None))
+            conds.append(cond)
+    return conds
+
+def _chave_filtros(filtros):
+    # Transforma o dict de multiselects em tupla ordenada (hashable para o cache)
+    return tuple(sorted((k, tuple(sorted(v))) for k, v in (filtros or {}).items() if v))
+
+def _filtrar_snapshot(df, filtros):
+    # Mesmos filtros do SQL, aplicados sobre o snapshot (vazios já vêm preenchidos com o valor exibido)
+    if df.empty: return pd.DataFrame(columns=COLS_PAINEL)
+    mask = None
+    for chave, valores in filtros:
+        if chave not in df.columns: continue
+        m = df[chave].isin(list(valores))
+        mask = m if mask is None else mask & m
+    return df if mask is None else df[mask]
+
+def consultar_lancamentos(cargo, id_usuario, filtros=None):
+    # Diretoria enxerga o ledger inteiro: filtra o snapshot do processo em vez de trazer outra cópia do banco
+    if cargo in CARGOS_GESTAO: return _filtrar_snapshot(carregar_dados(COLS_PAINEL), _chave_filtros(filtros))
+    return _consultar_lancamentos(cargo, str(id_usuario), _chave_filtros(filtros), revisao_ledger())
+
+@st.cache_data(ttl=300, max_entries=200, show_spinner=False)
+def _consultar_lancamentos(cargo, id_usuario, filtros, rev):
+    t = Lancamento.__table__
+    try:
+        with engine.connect() as conn:
+            return _ler_ledger_em_lotes(conn, *_condicoes_rls(t, cargo, id_usuario), *_condicoes_filtros(t, filtros), colunas=COLS_PAINEL)
     except Exception as e:
         print(f"Erro leitura SQL: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(columns=COLS_PAINEL)
+
+def opcoes_filtros_dashboard(cargo, id_usuario):
+    return _opcoes_filtros_dashboard(cargo, str(id_usuario), revisao_ledger())
+
+@st.cache_data(ttl=300, max_entries=200, show_spinner=False)
+def _opcoes_filtros_dashboard(cargo, id_usuario, rev):
+    # Valores distintos de cada filtro, já limitados ao que o usuário pode ver
+    t = Lancamento.__table__
+    rls = _condicoes_rls(t, cargo, id_usuario)
+    opcoes = {k: [] for k in FILTROS_DASHBOARD}; opcoes['Mes_Referencia'] = []
+    if cargo in CARGOS_GESTAO:
+        df = carregar_dados(COLS_PAINEL)
+        if df.empty: return opcoes
+        return {k: sorted(df[k].dropna().unique().tolist()) for k in opcoes}
+    try:
+        with engine.connect() as conn:
+            for chave, (col, vazio) in FILTROS_DASHBOARD.items():
+                vals = conn.execute(select(t.c[col]).where(*rls).distinct()).scalars()
+                opcoes[chave] = sorted({vazio if v is None else str(v) for v in vals})
+            datas = conn.execute(select(t.c.data_previsao).where(*rls).distinct()).scalars()
+            opcoes['Mes_Referencia'] = sorted({d.strftime('%m/%Y') for d in datas if d})
+    except Exception as e:
+        print(f"Erro leitura SQL: {e}")
+    return opcoes
 
-@st.cache_data(ttl=300, show_spinner=False)
 def carregar_usuarios_df():
+    return _carregar_usuarios_df(versao_tabela('usuarios'))
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _carregar_usuarios_df(versao):
     try: 
-        df = pd.read_sql("SELECT * FROM usuarios", engine)
+        df = _ler_tabela('usuarios', versao)
         # Limpa espaços que podem ter vindo da migração
         df['username'] = df['username'].str.strip()
         return df
     except: return pd.DataFrame()
 
-@st.cache_data(ttl=300, show_spinner=False)
 def carregar_clientes():
-    try: return pd.read_sql("SELECT * FROM clientes", engine)
-    except: return pd.DataFrame()
+    return _carregar_clientes(versao_tabela('clientes'))
 
 @st.cache_data(ttl=300, show_spinner=False)
-def carregar_regras_df():
-    try: return pd.read_sql("SELECT * FROM regras_comissao", engine)
+def _carregar_clientes(versao):
+    try: return _ler_tabela('clientes', versao)
     except: return pd.DataFrame()
 
+def carregar_regras_df():
+    return _carregar_regras_df(versao_tabela('regras_comissao'))
+
 @st.cache_data(ttl=300, show_spinner=False)
-def carregar_regras_dict():
-    df = carregar_regras_df()
-    regras = {}
-    for _, row in df.iterrows():
-        try:
-            raw_str = str(row['lista_percentuais']).replace(',', ' ')
-            lista = [float(x) for x in raw_str.split() if x.strip()]
-            regras[row['tipo_cota']] = {
-                'admin': str(row.get('administradora', 'Embracon')).strip(),
-                'pcts': lista,
-                'id_tabela': str(row.get('id_tabela', '')),
-                'min_credito': float(row.get('min_credito', 0)),
-                'max_credito': float(row.get('max_credito', 0)),
-                'min_prazo': int(row.get('min_prazo', 0)),
-                'max_prazo': int(row.get('max_prazo', 0)),
-                'taxa_antecipada': float(row.get('taxa_antecipada', 0)),
-                'ref_taxa_antecipada': str(row.get('ref_taxa_antecipada', '')),
-                'min_taxa_adm': float(row.get('min_taxa_adm', 0)),
-                'max_taxa_adm': float(row.get('max_taxa_adm', 0)),
-                'fundo_reserva': float(row.get('fundo_reserva', 0)),
-                'indice_reajuste': str(row.get('indice_reajuste', '')),
-                'modalidades_contemplacao': str(row.get('modalidades_contemplacao', '')),
-                'pct_estorno': float(row.get('pct_estorno', 0)),
-                'limite_parcela_estorno': int(row.get('limite_parcela_estorno', 3))
-            }
-        except: continue
-    return regras
+def _carregar_regras_df(versao):
+    try: return _ler_tabela('regras_comissao', versao)
+    except: return pd.DataFrame()
+
+# --- CATÁLOGO DE REGRAS COMPILADO ---
+# As regras são lidas e convertidas uma vez por revisão da tabela: Entuba, Cancelamentos, Simulador e Regras usam o mesmo objeto
+@dataclass(frozen=True, slots=True)
+class Regra:
+    tipo_cota: str
+    administradora: str
+    id_tabela: str
+    pcts: tuple
+    min_credito: float
+    max_credito: float
+    min_prazo: int
+    max_prazo: int
+    taxa_antecipada: float
+    ref_taxa_antecipada: str
+    min_taxa_adm: float
+    max_taxa_adm: float
+    fundo_reserva: float
+    pct_lance_embutido: float
+    indice_reajuste: str
+    modalidades_contemplacao: str
+    pct_estorno: float
+    limite_parcela_estorno: int
+
+    def esteira(self, n):
+        # Percentuais das n primeiras parcelas (zero onde a esteira acaba)
+        return (self.pcts + (0.0,) * n)[:n]
+
+def _compilar_regra(r):
+    # Conversões estritas como no antigo dicionário de regras: valor que não converte tira a regra do catálogo
+    lance = pd.to_numeric(r.get('pct_lance_embutido'), errors='coerce')
+    return Regra(
+        tipo_cota=r['tipo_cota'],
+        administradora=str(r.get('administradora', 'Embracon')).strip(),
+        id_tabela=str(r.get('id_tabela', '')),
+        pcts=tuple(float(x) for x in str(r['lista_percentuais']).replace(',', ' ').split()),
+        min_credito=float(r.get('min_credito', 0)),
+        max_credito=float(r.get('max_credito', 0)),
+        min_prazo=int(r.get('min_prazo', 0)),
+        max_prazo=int(r.get('max_prazo', 0)),
+        taxa_antecipada=float(r.get('taxa_antecipada', 0)),
+        ref_taxa_antecipada=str(r.get('ref_taxa_antecipada', '')),
+        min_taxa_adm=float(r.get('min_taxa_adm', 0)),
+        max_taxa_adm=float(r.get('max_taxa_adm', 0)),
+        fundo_reserva=float(r.get('fundo_reserva', 0)),
+        pct_lance_embutido=0.0 if pd.isna(lance) else float(lance),
+        indice_reajuste=str(r.get('indice_reajuste', '')),
+        modalidades_contemplacao=str(r.get('modalidades_contemplacao', '')),
+        pct_estorno=float(r.get('pct_estorno', 0)),
+        limite_parcela_estorno=int(r.get('limite_parcela_estorno', 3)),
+    )
+
+class CatalogoRegras:
+    # Regras válidas indexadas por tipo_cota, id_tabela e administradora; as que não compilaram ficam em `invalidas` com o motivo
+    def __init__(self, df):
+        self.por_tipo, self.invalidas = {}, {}
+        for r in (df.to_dict('records') if not df.empty else []):
+            try: self.por_tipo[r['tipo_cota']] = _compilar_regra(r)
+            except Exception as e: self.invalidas[r.get('tipo_cota')] = f"{type(e).__name__}: {e}"
+        self.por_tabela = {limpar_id(r.id_tabela): r for r in self.por_tipo.values() if r.id_tabela}
+        self.por_administradora = {}
+        for r in self.por_tipo.values(): self.por_administradora.setdefault(r.administradora, []).append(r)
+
+    def __bool__(self): return bool(self.por_tipo)
+    def __contains__(self, tipo): return tipo in self.por_tipo
+    def get(self, tipo): return self.por_tipo.get(tipo)
+
+    def tipo_da_tabela(self, id_tabela):
+        r = self.por_tabela.get(limpar_id(id_tabela))
+        return r.tipo_cota if r else None
+
+def carregar_regras():
+    return _carregar_regras(versao_tabela('regras_comissao'))
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _carregar_regras(versao):
+    # Objeto compartilhado (sem cópia por leitura): é só de consulta
+    return CatalogoRegras(_carregar_regras_df(versao))
 
-@st.cache_data(ttl=60, show_spinner=False)
 def carregar_aprovacoes_pendentes():
+    return _carregar_aprovacoes_pendentes(versao_tabela('vendas_pendentes'))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _carregar_aprovacoes_pendentes(versao):
     session = SessionLocal()
     try:
         engine = session.get_bind()
@@ -142,8 +631,11 @@ def carregar_aprovacoes_pendentes():
     finally:
         session.close()
 
-@st.cache_data(ttl=60, show_spinner=False)
 def carregar_meus_rascunhos(id_vendedor):
+    return _carregar_meus_rascunhos(id_vendedor, versao_tabela('vendas_pendentes'))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _carregar_meus_rascunhos(id_vendedor, versao):
     session = SessionLocal()
     try:
         engine = session.get_bind()
@@ -155,6 +647,38 @@ def carregar_meus_rascunhos(id_vendedor):
     finally:
         session.close()
 
+# --- ACESSO PREGUIÇOSO POR ABA ---
+# Cada aba declara (em app.py) os conjuntos de dados e as colunas que usa.
+# Nada é lido antes do primeiro acesso, e cada conjunto é carregado no máximo uma vez por rerun.
+CONJUNTOS_DADOS = {
+    'ledger': carregar_dados,
+    'usuarios': carregar_usuarios_df,
+    'clientes': carregar_clientes,
+    'regras': carregar_regras_df,
+    'aprovacoes': carregar_aprovacoes_pendentes,
+}
+
+class DadosAba:
+    def __init__(self, declaracao):
+        # declaracao: {conjunto: lista de colunas, ou None para todas}
+        self.declaracao = declaracao
+        self._carregados = {}
+
+    def __getitem__(self, conjunto):
+        if conjunto not in self.declaracao:
+            raise KeyError(f"Conjunto '{conjunto}' não declarado para esta aba")
+        if conjunto not in self._carregados:
+            colunas = self.declaracao[conjunto]
+            if conjunto == 'ledger':
+                # Ledger: a projeção vai até o SQL
+                df = carregar_dados(colunas)
+            else:
+                df = CONJUNTOS_DADOS[conjunto]()
+                if colunas is not None and not df.empty:
+                    df = df[[c for c in colunas if c in df.columns]]
+            self._carregados[conjunto] = df
+        return self._carregados[conjunto]
+
 # --- ESCRITA ---
 def adicionar_novo_usuario(id_u, nome, user, senha, tipo, tv, ts, tg, id_sup, id_ger):
     session = SessionLocal()
@@ -187,8 +711,9 @@ def adicionar_novo_usuario(id_u, nome, user, senha, tipo, tv, ts, tg, id_sup, id
             id_supervisor=id_sup,
             id_gerente=id_ger
         )
-        session.add(novo); session.commit()
-        st.cache_data.clear()
+        session.add(novo)
+        marcar_alteracao(session, 'usuarios')
+        session.commit()
         return True, "Cadastrado."
     except Exception as e: session.rollback(); return False, str(e)
     finally: session.close()
@@ -216,8 +741,8 @@ def excluir_usuario(id_u):
 
         # 4. Se passou por tudo, exclui
         session.delete(usuario)
+        marcar_alteracao(session, 'usuarios')
         session.commit()
-        st.cache_data.clear()
         return True, f"✅ Sucesso: Usuário '{usuario.nome_completo}' foi excluído permanentemente."
 
     except Exception as e:
@@ -232,8 +757,8 @@ def salvar_cliente_manual(id_c, nome, email, tel, obs):
         cli = session.query(Cliente).get(str(id_c))
         if cli: cli.nome_completo=nome; cli.email=email; cli.telefone=tel; cli.obs=obs; msg="Atualizado"
         else: session.add(Cliente(id_cliente=str(id_c), nome_completo=nome, email=email, telefone=tel, obs=obs)); msg="Criado"
+        marcar_alteracao(session, 'clientes')
         session.commit()
-        st.cache_data.clear()
         return True, msg
     except Exception as e: session.rollback(); return False, str(e)
     finally: session.close()
@@ -250,6 +775,7 @@ def auto_cadastrar_clientes_novos(lista_nomes):
             if nl.lower() not in exist and nl != '':
                 session.add(Cliente(id_cliente=str(pid), nome_completo=nl, obs='Auto')); pid+=1; c+=1
                 exist.add(nl.lower())
+        if c: marcar_alteracao(session, 'clientes')
         session.commit(); return c
     except: session.rollback(); return 0
     finally: session.close()
@@ -269,27 +795,227 @@ def salvar_regra_completa(d):
             indice_reajuste=d['indice_reajuste'], modalidades_contemplacao=m,
             pct_estorno=d['pct_estorno'], limite_parcela_estorno=d['limite_parcela_estorno']
         ))
-        st.cache_data.clear()
+        marcar_alteracao(session, 'regras_comissao')
         session.commit()
-        st.cache_data.clear()
         return True, "Salvo"
     except Exception as e: session.rollback(); return False, str(e)
     finally: session.close()
 
+# --- LEITURA DE PLANILHAS EM LOTES (UPLOADS) ---
+# Linhas por lote entregue aos processar_*; só um lote fica em memória por vez
+TAMANHO_LOTE_PLANILHA = int(st.secrets.get("UPLOAD_CHUNK", os.getenv("UPLOAD_CHUNK", 5000)))
+
+def ler_planilha_em_lotes(arquivo, progresso=None, tamanho=None):
+    # Leitura em si no módulo leitura (sem Streamlit/banco, usado também pelos processos do upload múltiplo)
+    return leitura.ler_planilha_em_lotes(arquivo, progresso, tamanho or TAMANHO_LOTE_PLANILHA)
+
+def _lotes(planilha):
+    # Os processar_* aceitam um DataFrame inteiro (ex.: aprovação de vendas) ou os lotes de ler_planilha_em_lotes
+    return [planilha] if isinstance(planilha, pd.DataFrame) else planilha
+
+def _com_arquivo(df, registros):
+    # Upload de vários arquivos: o log diz de qual planilha veio cada linha
+    nome = df.attrs.get('arquivo')
+    return [{'Arquivo': nome, **r} for r in registros] if nome else registros
+
+# --- EXTRATOS EM CSV / LARGURA FIXA (PERFIS POR ADMINISTRADORA) ---
+# Como ler o extrato de cada administradora e qual coluna (csv) ou posição [início, fim) (largura fixa) vira cada coluna da conciliação.
+# Perfis do secrets.toml ([PERFIS_EXTRATO."Nome"]) ou da variável PERFIS_EXTRATO (JSON) somam-se a estes ou os substituem.
+PERFIS_EXTRATO = {
+    'Padrão (CSV)': {'formato': 'csv'},
+    'CSV brasileiro (; e vírgula decimal)': {'formato': 'csv', 'separador': ';', 'decimal': ',', 'milhar': '.', 'encoding': 'latin-1'},
+    'Largura fixa padrão': {'formato': 'fixo', 'encoding': 'latin-1', 'casas_implicitas': 2,
+                            'campos': {'grupo': [0, 6], 'cota': [6, 12], 'num_parcela': [12, 17], 'valor_pago': [17, 31]}},
+}
+PERFIS_EXTRATO.update(st.secrets.get("PERFIS_EXTRATO", json.loads(os.getenv("PERFIS_EXTRATO", "{}"))))
+
+def ler_extrato_em_lotes(arquivo, perfil, progresso=None, tamanho=None):
+    # perfil: nome em PERFIS_EXTRATO ou o próprio dicionário; a leitura fica no módulo leitura
+    perfil = PERFIS_EXTRATO[perfil] if isinstance(perfil, str) else perfil
+    return leitura.ler_extrato_em_lotes(arquivo, perfil, progresso, tamanho or TAMANHO_LOTE_PLANILHA)
+
+# --- UPLOAD DE VÁRIOS ARQUIVOS / ZIP ---
+def _abrir_uploads(arquivos, extensoes=('.xlsx',)):
+    # Lista (nome, bytes) de cada arquivo enviado, abrindo os .zip (pastas internas, lixo do macOS e outras extensões são ignorados)
+    itens = []
+    for arq in arquivos:
+        nome = getattr(arq, 'name', str(arq))
+        dados = arq.getvalue() if hasattr(arq, 'getvalue') else open(arq, 'rb').read()
+        if not nome.lower().endswith('.zip'): itens.append((nome, dados)); continue
+        with zipfile.ZipFile(io.BytesIO(dados)) as z:
+            for info in z.infolist():
+                if info.is_dir() or '__MACOSX' in info.filename or not info.filename.lower().endswith(extensoes): continue
+                itens.append((f"{nome}/{info.filename}", z.read(info)))
+    return itens
+
+# Pool único do processo para ler os arquivos de um upload múltiplo: processos (o parse do pandas/openpyxl segura o GIL),
+# criados sob demanda por spawn (nada de fork dentro do servidor multithread do Streamlit). Os processos só importam o
+# módulo leitura, recebem os bytes de cada arquivo e devolvem um DataFrame por arquivo
+_pool_leitura = None
+_trava_pool = threading.Lock()
+
+def _pool():
+    global _pool_leitura
+    with _trava_pool:
+        if _pool_leitura is None:
+            _pool_leitura = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1), mp_context=multiprocessing.get_context('spawn'))
+        return _pool_leitura
+
+def _ler_em_processos(itens, obrigatorias, perfil):
+    global _pool_leitura
+    n = len(itens)
+    try: return list(_pool().map(leitura.ler_arquivo, *zip(*itens), [obrigatorias] * n, [perfil] * n, [TAMANHO_LOTE_PLANILHA] * n))
+    except BrokenProcessPool:
+        # Processo do pool morreu (ex.: falta de memória): descarta o pool (o próximo upload cria outro) e lê aqui mesmo
+        logger.warning("Pool de leitura quebrado; lendo os arquivos no próprio processo")
+        with _trava_pool: _pool_leitura = None
+        return [leitura.ler_arquivo(nome, dados, obrigatorias, perfil, TAMANHO_LOTE_PLANILHA) for nome, dados in itens]
+
+def processar_varios_arquivos(processador, arquivos, obrigatorias=(), perfil=None):
+    # Lê/valida cada planilha em paralelo (processos do pool de leitura) e grava tudo pelo processar_* numa única transação.
+    # Arquivos inválidos ficam de fora e aparecem no log consolidado, junto com as linhas de todos os outros.
+    # Com perfil (nome em PERFIS_EXTRATO), os .csv/.txt também são aceitos, inclusive dentro dos .zip.
+    itens = _abrir_uploads(arquivos, ('.xlsx', *EXTENSOES_TEXTO) if perfil else ('.xlsx',))
+    perfil = PERFIS_EXTRATO[perfil] if isinstance(perfil, str) else perfil
+    if len(itens) > 1: lidos = _ler_em_processos(itens, obrigatorias, perfil)
+    else: lidos = [leitura.ler_arquivo(n, d, obrigatorias, perfil, TAMANHO_LOTE_PLANILHA) for n, d in itens]
+    
+    lotes, falhas = [], []
+    for (nome, df, erro), (_, dados) in zip(lidos, itens):
+        if erro: falhas.append({'Arquivo': nome, 'Linha': '-', 'Status': '❌ Erro Crítico', 'Detalhe': erro}); continue
+        df.attrs.update(arquivo=nome, nome_arquivo=nome, hash_arquivo=hashlib.sha256(dados).hexdigest()); lotes.append(df)
+    *resultado, logs = processador(lotes)
+    if not falhas: return (*resultado, logs)
+    todos = pd.concat([pd.DataFrame(falhas), logs], ignore_index=True)
+    return (*resultado, todos[list(dict.fromkeys(['Arquivo', *logs.columns, *todos.columns]))])
+
+# --- GRAVAÇÃO EM LOTE (CORE) ---
+# Linhas por INSERT multi-linha; o executemany do Core evita montar e acompanhar um objeto ORM por linha
+TAMANHO_LOTE_ESCRITA = int(st.secrets.get("LEDGER_WRITE_BATCH", os.getenv("LEDGER_WRITE_BATCH", 1000)))
+
+def _inserir_em_lotes(session, modelo, registros):
+    # Roda dentro da transação da sessão: o chamador decide commit/rollback (tudo ou nada)
+    t = modelo.__table__
+    for i in range(0, len(registros), TAMANHO_LOTE_ESCRITA):
+        session.execute(insert(t), registros[i:i + TAMANHO_LOTE_ESCRITA])
+    return len(registros)
+
+# Valores por IN (...): abaixo do limite de parâmetros do SQLite antigo (999)
+TAMANHO_LOTE_CONSULTA = 500
+
+def _lancamentos_existentes(session, ids_venda):
+    # Só as vendas da planilha, em lotes de IN sobre o índice de id_venda: o custo cresce com o upload, não com o ledger
+    t = Lancamento.__table__
+    ids = list(dict.fromkeys(ids_venda)); exist = set()
+    for i in range(0, len(ids), TAMANHO_LOTE_CONSULTA):
+        exist.update(session.execute(select(t.c.id_lancamento).where(t.c.id_venda.in_(ids[i:i + TAMANHO_LOTE_CONSULTA]))).scalars())
+    return exist
+
+def _buscar_lancamentos(session, coluna, valores, simular=False):
+    # Lançamentos com `coluna` em `valores`: uma consulta por lote de IN, não uma por linha da planilha.
+    # Na simulação vêm como registros soltos (SELECT simples, sem ORM): podem ser alterados sem risco de flush.
+    t = Lancamento.__table__
+    valores = list(dict.fromkeys(valores)); achados = []
+    for i in range(0, len(valores), TAMANHO_LOTE_CONSULTA):
+        fatia = valores[i:i + TAMANHO_LOTE_CONSULTA]
+        if simular: achados += [SimpleNamespace(**r) for r in session.execute(select(t).where(t.c[coluna].in_(fatia))).mappings()]
+        else: achados += session.query(Lancamento).filter(getattr(Lancamento, coluna).in_(fatia)).all()
+    return achados
+
+def _registrar_gravacao(origem, linhas, segundos):
+    logger.info("%s (%s): %s linhas gravadas em %.2fs, %.0f linhas/s (lotes de %s)", origem, engine.dialect.name, linhas, segundos, linhas / max(segundos, 1e-9), TAMANHO_LOTE_ESCRITA)
+
+# --- CHECKPOINTS DE UPLOAD (GRAVAÇÃO EM BLOCOS) ---
+# Padrão de linhas por bloco confirmado quando a gravação em blocos é pedida
+TAMANHO_BLOCO_COMMIT = int(st.secrets.get("ENTUBA_COMMIT_CHUNK", os.getenv("ENTUBA_COMMIT_CHUNK", 2000)))
+# Checkpoint de um envio abandonado (nunca reenviado) expira depois desses dias
+VALIDADE_CHECKPOINT_DIAS = int(st.secrets.get("CHECKPOINT_TTL_DAYS", os.getenv("CHECKPOINT_TTL_DAYS", 7)))
+
+def chave_upload(*conteudos):
+    # Identidade do envio: o mesmo arquivo (ou o mesmo conjunto, na mesma ordem) gera a mesma chave
+    h = hashlib.sha256()
+    for c in conteudos: h.update(hashlib.sha256(c).digest())
+    return h.hexdigest()
+
+def _ler_checkpoint(session, chave):
+    # Antes de ler, descarta os checkpoints vencidos (o de um envio expirado recomeça do zero, com as duplicatas ignoradas)
+    t = CheckpointUpload.__table__
+    session.execute(t.delete().where(t.c.data_atualizacao < datetime.now() - relativedelta(days=VALIDADE_CHECKPOINT_DIAS)))
+    return session.execute(select(t.c.linhas).where(t.c.chave == chave)).scalar() or 0
+
+def _salvar_checkpoint(session, chave, origem, linhas):
+    # Na mesma transação do bloco: o checkpoint nunca aponta além do que foi de fato gravado
+    session.merge(CheckpointUpload(chave=chave, origem=origem, linhas=linhas, data_atualizacao=datetime.now()))
+
+# --- HISTÓRICO DE IMPORTAÇÕES (IMPRESSÃO DIGITAL POR LINHA) ---
+def _hash_linha(origem, *partes):
+    # Conteúdo já normalizado (o mesmo lançamento vindo de .xlsx ou .csv gera o mesmo hash)
+    return hashlib.sha256('\x1f'.join(map(str, (origem, *partes))).encode()).hexdigest()
+
+def _impressao(origem, df, linha, hash_linha):
+    # Registro do histórico de uma linha do upload; o id_lancamento entra quando a linha for de fato aplicada
+    return {'origem': origem, 'hash_linha': hash_linha, 'hash_arquivo': df.attrs.get('hash_arquivo'),
+            'arquivo': df.attrs.get('nome_arquivo'), 'linha': linha}
+
+def _ja_importadas(session, origem, hashes):
+    # hash da linha -> (arquivo, data) das linhas aplicadas por uploads anteriores; lê só o histórico, nunca o ledger
+    t = HistoricoImportacao.__table__
+    hashes = list(dict.fromkeys(h for h in hashes if h)); achadas = {}
+    for k in range(0, len(hashes), TAMANHO_LOTE_CONSULTA):
+        filtro = and_(t.c.origem == origem, t.c.hash_linha.in_(hashes[k:k + TAMANHO_LOTE_CONSULTA]))
+        for h, arq, data in session.execute(select(t.c.hash_linha, t.c.arquivo, t.c.data_importacao).where(filtro)):
+            achadas.setdefault(h, (arq, data))
+    return achadas
+
+def _log_ja_importada(anterior):
+    arq, data = anterior
+    return {'Status': '⚠️ Já Importado', 'Detalhe': f'Linha já aplicada em {data:%d/%m/%Y %H:%M} pelo arquivo {arq or "sem nome"}'}
+
+def _gravar_historico(session, registros):
+    # Na mesma transação das baixas/cancelamentos: o histórico nunca registra o que não foi gravado
+    agora = datetime.now()
+    _inserir_em_lotes(session, HistoricoImportacao, [{**r, 'data_importacao': agora} for r in registros])
+
+def consultar_historico_importacoes(busca='', limite=500):
+    # Últimas linhas aplicadas por upload; busca pelo ID do lançamento (prefixo, ex.: "Embracon_1234_56") ou pelo nome do arquivo
+    t = HistoricoImportacao.__table__
+    q = select(t.c.data_importacao, t.c.origem, t.c.arquivo, t.c.linha, t.c.id_lancamento, t.c.hash_arquivo).order_by(t.c.id.desc()).limit(limite)
+    if busca: q = q.where(or_(t.c.id_lancamento.startswith(busca, autoescape=True), t.c.arquivo.contains(busca, autoescape=True)))
+    with engine.connect() as conn:
+        df = pd.DataFrame(conn.execute(q).all(), columns=['Data', 'Origem', 'Arquivo', 'Linha', 'ID_Lancamento', 'Hash_Arquivo'])
+    return df
+
 # --- PROCESSAMENTO ENTUBA ---
-def processar_vendas_upload(df):
-    REGRAS = carregar_regras_dict()
+def _coluna(df, nome, padrao=None):
+    # Coluna da planilha como objeto (equivale ao row.get(nome, padrao) do antigo laço linha a linha)
+    if nome in df.columns: return df[nome].astype(object)
+    return pd.Series([padrao] * len(df), index=df.index, dtype=object)
+
+def _mapear(serie, funcao):
+    # Series.map infere o dtype (None viraria NaN); aqui o resultado fica como objeto, valor a valor
+    return pd.Series([funcao(v) for v in serie], index=serie.index, dtype=object)
+
+# --- CRONOGRAMA DE PARCELAS (MEMOIZADO) ---
+# Poucas combinações (data da venda, dia de vencimento) se repetem por milhares de vendas: cada uma é calculada uma vez só
+TAMANHO_CACHE_CRONOGRAMA = int(st.secrets.get("SCHEDULE_CACHE", os.getenv("SCHEDULE_CACHE", 4096)))
+
+@lru_cache(maxsize=TAMANHO_CACHE_CRONOGRAMA)
+def cronograma_parcelas(data_venda, dia_vencimento, n=12):
+    # 1ª parcela na data da venda; as demais mês a mês, com um mês a mais se a venda caiu no dia do vencimento ou depois
+    # (relativedelta limita o dia ao último dia do mês de destino). Devolve uma tupla: o resultado é compartilhado pelo cache
+    sh = int(data_venda.day >= dia_vencimento)
+    return tuple(data_venda if i == 0 else data_venda + relativedelta(months=i + sh) for i in range(n))
+
+def _ler_data_venda(v):
+    try: return pd.to_datetime(v, dayfirst=True)
+    except: return pd.NaT
+
+def processar_vendas_upload(planilha, simular=False, commit_a_cada=None, chave=None):
+    # simular=True: só leituras, nada é gravado; devolve (ok, ign, parcelas_previstas, logs)
+    # commit_a_cada=N: confirma a cada N vendas e guarda o checkpoint em `chave`; reenviar o mesmo arquivo retoma dali
+    REGRAS = carregar_regras()
     if not REGRAS: return 0, 0, pd.DataFrame([{'Status': 'Erro Crítico', 'Detalhe': 'Nenhuma regra de comissão cadastrada (Aba 6)'}])
     
-    # Busca o DataFrame completo de regras para o cálculo do Valor do Cliente
-    df_regras_full = carregar_regras_df()
-    regras_completas = df_regras_full.set_index('tipo_cota').to_dict('index') if not df_regras_full.empty else {}
-    
-    # Padroniza Excel
-    df.columns = df.columns.str.strip().str.lower()
-    
-    mapa_tab = {limpar_id(v['id_tabela']): k for k,v in REGRAS.items() if v.get('id_tabela')}
-    
     df_u = carregar_usuarios_df()
     map_u = dict(zip(df_u['id_usuario'], df_u['nome_completo']))
     map_tv = dict(zip(df_u['id_usuario'], pd.to_numeric(df_u.get('taxa_vendedor', 0.2)).fillna(0.2)))
@@ -297,8 +1023,8 @@ def processar_vendas_upload(df):
     map_tg = dict(zip(df_u['id_usuario'], pd.to_numeric(df_u.get('taxa_gerencia', 0.1)).fillna(0.1)))
     
     # Mapas de Inteligência (Puxa quem é o chefe do Vendedor)
-    map_sup_link = dict(zip(df_u['id_usuario'], df_u.get('id_supervisor', pd.Series([''] * len(df_u))).fillna('')))
-    map_ger_link = dict(zip(df_u['id_usuario'], df_u.get('id_gerente', pd.Series([''] * len(df_u))).fillna('')))
+    map_sup_link = dict(zip(df_u['id_usuario'], df_u.get('id_supervisor', pd.Series([''] * len(df_u))).map(lambda v: limpar_id(v) or '')))
+    map_ger_link = dict(zip(df_u['id_usuario'], df_u.get('id_gerente', pd.Series([''] * len(df_u))).map(lambda v: limpar_id(v) or '')))
     
     df_c = carregar_clientes()
     map_cid = dict(zip(df_c['id_cliente'], df_c['nome_completo']))
@@ -307,261 +1033,464 @@ def processar_vendas_upload(df):
     except: pcid = 1
     
     session = SessionLocal()
-    exist = {x[0] for x in session.query(Lancamento.id_lancamento).all()}
-    
-    novos = []; ncli_obj = []; logs = []; ign = 0; ok = 0
     
-    for idx, row in df.iterrows():
-        linha_excel = idx + 2
-        cliente_nome = str(row.get('cliente', 'Desc.')).strip()
-        
-        tipo = row.get('tipo_cota')
-        if not tipo and 'id_tabela' in row: tipo = mapa_tab.get(limpar_id(row['id_tabela']))
+    def gerar_lote(df):
+        # Uma fatia da planilha (ou ela inteira): valida, resolve clientes e monta as parcelas
+        nonlocal pcid
+        # Padroniza Excel
+        df.columns = df.columns.str.strip().str.lower()
+        linhas = df.index.to_numpy() + 2
+        df = df.reset_index(drop=True)
         
-        if not tipo or tipo not in REGRAS: 
-            logs.append({'Linha': linha_excel, 'Cliente': cliente_nome, 'Status': '❌ Erro', 'Detalhe': 'Produto/Regra não encontrado'})
-            continue
-        
-        reg = REGRAS[tipo]
-        reg_c = regras_completas.get(tipo, {}) 
-        
-        iv = limpar_id(row.get('id_vendedor'))
-        if iv not in map_u: 
-            logs.append({'Linha': linha_excel, 'Cliente': cliente_nome, 'Status': '❌ Erro', 'Detalhe': f'Vendedor ID {iv} inexistente'})
-            continue
-            
+        # --- VALIDAÇÃO POR COLUNA (mesma ordem de checagem de antes: regra, vendedor, cliente, data) ---
+        cliente_nome = _coluna(df, 'cliente', 'Desc.').map(lambda v: str(v).strip())
+    
+        tipo = _coluna(df, 'tipo_cota')
+        if 'id_tabela' in df.columns:
+            tipo = tipo.where(tipo.map(bool), _mapear(df['id_tabela'], REGRAS.tipo_da_tabela))
+        ok_tipo = tipo.map(lambda t: bool(t) and t in REGRAS).to_numpy(bool)
+    
+        iv = _mapear(_coluna(df, 'id_vendedor'), limpar_id)
+        ok_vend = ok_tipo & iv.map(lambda v: v in map_u).to_numpy(bool)
+    
         # --- PREENCHIMENTO AUTOMÁTICO DA HIERARQUIA ---
-        isup = map_sup_link.get(iv)
-        ig = map_ger_link.get(iv)
-        
         # Caso a planilha venha com um gerente forçado, ele acata. Se não, usa o automático do banco.
-        if not isup and 'id_supervisor' in row: isup = limpar_id(row.get('id_supervisor'))
-        if not ig and 'id_gerente' in row: ig = limpar_id(row.get('id_gerente'))
-        
-        cnm = cliente_nome
-        cid_xls = limpar_id(row.get('id_cliente'))
-        cid_final = None
-        
-        if cid_xls and cid_xls in map_cid: 
-            cid_final=cid_xls; cnm=map_cid[cid_xls]
-        elif cnm.lower() in map_cnm: 
-            cid_final=map_cnm[cnm.lower()]
-        else:
-            cid_final = str(pcid)
-            ncli_obj.append(Cliente(id_cliente=cid_final, nome_completo=cnm, obs='Auto Entuba'))
-            map_cnm[cnm.lower()] = cid_final; pcid+=1
-            logs.append({'Linha': linha_excel, 'Cliente': cnm, 'Status': 'Info', 'Detalhe': 'Novo cliente cadastrado'})
-
-        grp = str(row.get('grupo')).replace('.0',''); cta = str(row.get('cota')).replace('.0','')
-        idv = f"{reg.get('admin', reg_c.get('administradora', ''))}_{grp}_{cta}"
-        
-        try: dtv = pd.to_datetime(row['data_venda'], dayfirst=True)
-        except: logs.append({'Linha': linha_excel, 'Cliente': cnm, 'Status': '❌ Erro', 'Detalhe': 'Data inválida'}); continue
-
-        dc = int(row.get('dia_vencimento', 15))
-        sh = 1 if dtv.day >= dc else 0
-        vcred = float(row.get('valor_credito', 0))
-        
-        # --- MATEMÁTICA PADRÃO DO VALOR DO CLIENTE ---
-        prazo_venda = pd.to_numeric(row.get('prazo'), errors='coerce')
-        if pd.isna(prazo_venda) or prazo_venda <= 0: prazo_venda = float(reg_c.get('max_prazo', 1))
-
-        taxa_adm_venda = pd.to_numeric(row.get('taxa_adm'), errors='coerce')
-        if pd.isna(taxa_adm_venda): taxa_adm_venda = float(reg_c.get('max_taxa_adm', 0))
-
-        fundo_res = float(reg_c.get('fundo_reserva', 0))
-        taxa_antecipada = float(reg_c.get('taxa_antecipada', 0))
-
+        isup = _mapear(iv, map_sup_link.get)
+        ig = _mapear(iv, map_ger_link.get)
+        if 'id_supervisor' in df.columns: isup = isup.where(isup.map(bool), _mapear(df['id_supervisor'], limpar_id))
+        if 'id_gerente' in df.columns: ig = ig.where(ig.map(bool), _mapear(df['id_gerente'], limpar_id))
+    
+        # --- CLIENTES: ID da planilha, depois nome; nomes novos ganham ID na ordem em que aparecem ---
+        cid_xls = _mapear(_coluna(df, 'id_cliente'), limpar_id)
+        por_id = cid_xls.map(lambda c: bool(c) and c in map_cid).to_numpy(bool)
+        cnm = cliente_nome.where(~por_id, _mapear(cid_xls, map_cid.get))
+        chave = cliente_nome.str.lower()
+        cid_final = cid_xls.where(por_id, _mapear(chave, map_cnm.get))
+    
+        cli_novo = ok_vend & ~por_id & cid_final.isna().to_numpy()
+        primeiros = chave[cli_novo].drop_duplicates()
+        cli_primeiro = df.index.isin(primeiros.index)
+        novos_ids = dict(zip(primeiros, map(str, range(pcid, pcid + len(primeiros)))))
+        cid_final = cid_final.where(~cli_novo, chave.map(novos_ids))
+        map_cnm.update(novos_ids); pcid += len(primeiros)
+        ncli = [{'id_cliente': c, 'nome_completo': n, 'obs': 'Auto Entuba'} for c, n in zip(cid_final[cli_primeiro], cnm[cli_primeiro])]
+    
+        # Datas convertidas uma vez por valor distinto (planilhas repetem muito a data da venda)
+        if 'data_venda' in df.columns:
+            datas = {}
+            dtv = pd.to_datetime(pd.Series([datas[v] if v in datas else datas.setdefault(v, _ler_data_venda(v)) for v in df['data_venda']], dtype=object))
+        else: dtv = pd.Series(pd.NaT, index=df.index)
+        val = ok_vend & dtv.notna().to_numpy()
+    
+        # --- MATEMÁTICA PADRÃO DO VALOR DO CLIENTE (coluna inteira por vez, só nas linhas válidas) ---
+        tipo_v = tipo[val]
+        reg_c = _mapear(tipo_v, REGRAS.get)
+        dc = _coluna(df, 'dia_vencimento', 15)[val].map(int).to_numpy()
+        vcred = _coluna(df, 'valor_credito', 0)[val].map(float).to_numpy(float)
+    
+        prazo_venda = pd.to_numeric(_coluna(df, 'prazo')[val], errors='coerce')
+        sem_prazo = ~(prazo_venda > 0)
+        prazo_venda = prazo_venda.astype(float)
+        prazo_venda[sem_prazo] = reg_c[sem_prazo].map(lambda r: float(r.max_prazo))
+    
+        taxa_adm_venda = pd.to_numeric(_coluna(df, 'taxa_adm')[val], errors='coerce').astype(float)
+        sem_taxa = taxa_adm_venda.isna()
+        taxa_adm_venda[sem_taxa] = reg_c[sem_taxa].map(lambda r: r.max_taxa_adm)
+    
+        fundo_res = reg_c.map(lambda r: r.fundo_reserva).to_numpy(float)
+        taxa_antecipada = reg_c.map(lambda r: r.taxa_antecipada).to_numpy(float)
+        prazo_venda = prazo_venda.to_numpy(float); taxa_adm_venda = taxa_adm_venda.to_numpy(float)
+    
         valor_taxa_adm = vcred * (taxa_adm_venda / 100.0)
         valor_fundo_res = vcred * (fundo_res / 100.0)
         valor_antecipacao = vcred * (taxa_antecipada / 100.0)
-
+    
         total_divida = vcred + valor_taxa_adm + valor_fundo_res
         saldo_restante = total_divida - valor_antecipacao
-        parcela_normal = saldo_restante / prazo_venda if prazo_venda > 0 else 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            parcela_normal = np.where(prazo_venda > 0, saldo_restante / prazo_venda, 0.0)
         primeira_parcela = parcela_normal + valor_antecipacao
-
-        # --- NOVO: OVERRIDE MANUAL SE PREENCHIDO NA PLANILHA ---
-        val_pri_manual = pd.to_numeric(row.get('valor_primeira_parcela'), errors='coerce')
-        val_dem_manual = pd.to_numeric(row.get('valor_demais_parcelas'), errors='coerce')
-
-        if pd.notna(val_pri_manual) and val_pri_manual > 0:
-            primeira_parcela = val_pri_manual
-            
-        if pd.notna(val_dem_manual) and val_dem_manual > 0:
-            parcela_normal = val_dem_manual
-
-        # --- GERAÇÃO DAS PARCELAS ---
-        pcts = reg['pcts']
-        parcelas_criadas_na_linha = 0
+    
+        # --- OVERRIDE MANUAL SE PREENCHIDO NA PLANILHA ---
+        val_pri_manual = pd.to_numeric(_coluna(df, 'valor_primeira_parcela')[val], errors='coerce').to_numpy(float)
+        val_dem_manual = pd.to_numeric(_coluna(df, 'valor_demais_parcelas')[val], errors='coerce').to_numpy(float)
+        primeira_parcela = np.where(val_pri_manual > 0, val_pri_manual, primeira_parcela)
+        parcela_normal = np.where(val_dem_manual > 0, val_dem_manual, parcela_normal)
+    
+        # --- GERAÇÃO DAS PARCELAS: cada venda vira 12 linhas de uma vez ---
         total_parcelas_fixo = 12
-        
-        for i in range(total_parcelas_fixo):
-            idl = f"{idv}_P{i+1}"
-            if idl in exist: 
-                ign += 1; continue
-            
-            dp = dtv if i==0 else dtv+relativedelta(months=i+sh)
-            pct = pcts[i] if i < len(pcts) else 0.0
-            
-            valor_cliente_atual = primeira_parcela if i == 0 else parcela_normal
-            status_pg_cli = 'Pago' if i == 0 else 'Pendente'
-            
-            # --- NOVO: STATUS INTELIGENTE ---
-            status_pg_sup = 'Pendente' if isup else 'Isento'
-            status_pg_ger = 'Pendente' if ig else 'Isento'
-            
-            vb = vcred * (pct/100)
-            pv = vb * map_tv.get(iv, 0.2)
-            ps = vb * map_ts.get(isup, 0.1) if isup else 0.0
-            pg = vb * map_tg.get(ig, 0.1) if ig else 0.0
-            
-            novos.append(Lancamento(
-                id_lancamento=idl, id_venda=idv, administradora=reg.get('admin', reg_c.get('administradora')),
-                grupo=grp, cota=cta, tipo_cota=tipo, 
-                parcela=f"{i+1}/{total_parcelas_fixo}",
-                data_previsao=dp.date(), id_cliente=cid_final, cliente=cnm,
-                id_vendedor=iv, vendedor=map_u.get(iv,''), 
-                id_supervisor=isup, supervisor=map_u.get(isup,''),
-                id_gerente=ig, gerente=map_u.get(ig,''), 
-                valor_cliente=round(valor_cliente_atual, 2), 
-                receber_administradora=round(vb,2), 
-                pagar_vendedor=round(pv,2), pagar_supervisor=round(ps,2), pagar_gerente=round(pg,2),
-                liquido_caixa=round(vb-pv-ps-pg, 2), 
-                status_recebimento='Pendente', status_pgto_cliente=status_pg_cli,
-                status_pgto_vendedor='Pendente', 
-                status_pgto_supervisor=status_pg_sup, # Recebe 'Isento' se vazio
-                status_pgto_gerente=status_pg_ger     # Recebe 'Isento' se vazio
-            ))
-            exist.add(idl); parcelas_criadas_na_linha += 1; ok += 1
-        
-        if parcelas_criadas_na_linha > 0:
-            logs.append({'Linha': linha_excel, 'Cliente': cnm, 'Status': '✅ Sucesso', 'Detalhe': f'{parcelas_criadas_na_linha} parcelas geradas'})
-        else:
-             logs.append({'Linha': linha_excel, 'Cliente': cnm, 'Status': '⚠️ Ignorado', 'Detalhe': 'Todas as parcelas já existiam'})
-
+        nv = int(val.sum())
+        i = np.tile(np.arange(total_parcelas_fixo), nv)
+        rep = lambda a: np.repeat(np.asarray(a, dtype=object) if not isinstance(a, np.ndarray) else a, total_parcelas_fixo)
+    
+        admin = reg_c.map(lambda r: r.administradora)
+        grp = _coluna(df, 'grupo')[val].map(lambda v: str(v).replace('.0',''))
+        cta = _coluna(df, 'cota')[val].map(lambda v: str(v).replace('.0',''))
+        idv = (admin + '_' + grp + '_' + cta).tolist()
+        idl = [f"{v}_P{k + 1}" for v in idv for k in range(total_parcelas_fixo)]
+    
+        # Parcela já no banco ou repetida mais acima na própria planilha é ignorada
+        exist = _lancamentos_existentes(session, idv) | previstas
+        criar = ~pd.Series(idl, dtype=object).isin(exist).to_numpy() & ~pd.Series(idl, dtype=object).duplicated().to_numpy()
+        ok = int(criar.sum()); ign = len(idl) - ok
+        # Na simulação nada vai ao banco: os lotes seguintes precisam saber o que este "criaria"
+        if simular: previstas.update(np.array(idl, dtype=object)[criar])
+    
+        dp = np.array([d for dv, dia in zip(dtv[val].dt.date, dc.tolist()) for d in cronograma_parcelas(dv, dia, total_parcelas_fixo)], dtype=object)
+    
+        pcts = np.array([r.esteira(total_parcelas_fixo) for r in reg_c], dtype=float).reshape(-1)
+        iv_v, isup_v, ig_v = iv[val].tolist(), isup[val].tolist(), ig[val].tolist()
+        tem_sup = rep(np.array([bool(s) for s in isup_v], dtype=bool)); tem_ger = rep(np.array([bool(g) for g in ig_v], dtype=bool))
+    
+        vb = np.repeat(vcred, total_parcelas_fixo) * (pcts / 100)
+        pv = vb * np.repeat([map_tv.get(v, 0.2) for v in iv_v], total_parcelas_fixo)
+        ps = np.where(tem_sup, vb * np.repeat([map_ts.get(s, 0.1) for s in isup_v], total_parcelas_fixo), 0.0)
+        pg = np.where(tem_ger, vb * np.repeat([map_tg.get(g, 0.1) for g in ig_v], total_parcelas_fixo), 0.0)
+        valor_cliente = np.where(i == 0, np.repeat(primeira_parcela, total_parcelas_fixo), np.repeat(parcela_normal, total_parcelas_fixo))
+        # round() do Python, como antes (np.round diverge nos casos de meio centavo)
+        arred = lambda a: [round(x, 2) for x in a[criar].tolist()]
+    
+        parcelas = pd.DataFrame({
+            'id_lancamento': np.array(idl, dtype=object)[criar], 'id_venda': rep(idv)[criar], 'administradora': rep(admin)[criar],
+            'grupo': rep(grp)[criar], 'cota': rep(cta)[criar], 'tipo_cota': rep(tipo_v)[criar],
+            'parcela': [f"{k + 1}/{total_parcelas_fixo}" for k in i[criar]],
+            'num_parcela': (i[criar] + 1).tolist(), 'total_parcelas': total_parcelas_fixo, 'is_estorno': False,
+            'data_previsao': dp[criar], 'id_cliente': rep(cid_final[val])[criar], 'cliente': rep(cnm[val])[criar],
+            'id_vendedor': rep(iv_v)[criar], 'vendedor': rep([map_u.get(v, '') for v in iv_v])[criar],
+            'id_supervisor': rep(isup_v)[criar], 'supervisor': rep([map_u.get(s, '') for s in isup_v])[criar],
+            'id_gerente': rep(ig_v)[criar], 'gerente': rep([map_u.get(g, '') for g in ig_v])[criar],
+            'valor_cliente': arred(valor_cliente), 'receber_administradora': arred(vb),
+            'pagar_vendedor': arred(pv), 'pagar_supervisor': arred(ps), 'pagar_gerente': arred(pg),
+            'liquido_caixa': arred(vb - pv - ps - pg),
+            'status_recebimento': 'Pendente', 'status_pgto_cliente': np.where(i == 0, 'Pago', 'Pendente')[criar],
+            'status_pgto_vendedor': 'Pendente',
+            'status_pgto_supervisor': np.where(tem_sup, 'Pendente', 'Isento')[criar], # Recebe 'Isento' se vazio
+            'status_pgto_gerente': np.where(tem_ger, 'Pendente', 'Isento')[criar],     # Recebe 'Isento' se vazio
+        }, dtype=object)
+        novos = parcelas.where(parcelas.notna(), None).to_dict('records')
+    
+        # --- LOG POR LINHA (mesmas mensagens e ordem de antes) ---
+        criadas = np.zeros(len(df), dtype=int)
+        criadas[val] = criar.reshape(-1, total_parcelas_fixo).sum(axis=1) if nv else 0
+        partes = [
+            (~ok_tipo, 1, cliente_nome, '❌ Erro', 'Produto/Regra não encontrado'),
+            (ok_tipo & ~ok_vend, 1, cliente_nome, '❌ Erro', 'Vendedor ID ' + iv.map(str) + ' inexistente'),
+            (cli_primeiro, 0, cnm, 'Info', 'Novo cliente cadastrado'),
+            (ok_vend & ~val, 1, cnm, '❌ Erro', 'Data inválida'),
+            (val & (criadas > 0), 1, cnm, '✅ Sucesso', pd.Series(criadas, index=df.index).astype(str) + ' parcelas geradas'),
+            (val & (criadas == 0), 1, cnm, '⚠️ Ignorado', 'Todas as parcelas já existiam'),
+        ]
+        logs = pd.concat([
+            pd.DataFrame({'pos': np.flatnonzero(m), 'ordem': o, 'Linha': linhas[m], 'Cliente': c[m].to_numpy(object), 'Status': s,
+                          'Detalhe': d[m].to_numpy(object) if isinstance(d, pd.Series) else d})
+            for m, o, c, s, d in partes if m.any()
+        ]).sort_values(['pos', 'ordem'], kind='stable').drop(columns=['pos', 'ordem']).reset_index(drop=True)
+        return ok, ign, logs, ncli, novos
+    
+    ok = ign = gravadas = 0; logs = []; previstas = set(); previa = []
+    # Sem blocos, tudo numa transação só: os lotes são gravados à medida que chegam, mas qualquer erro desfaz clientes e parcelas.
+    # Em blocos, cada N vendas são confirmadas com o checkpoint (linhas percorridas na ordem do arquivo) e um erro só desfaz o bloco atual
+    em_blocos = bool(commit_a_cada) and bool(chave) and not simular
+    ok_conf = ign_conf = feitas = feitas_conf = logs_conf = 0
     try:
-        if ncli_obj: session.add_all(ncli_obj)
-        if novos: session.add_all(novos)
+        t0 = time.perf_counter()
+        retomar = _ler_checkpoint(session, chave) if em_blocos else 0
+        feitas_conf = retomar
+        if retomar:
+            logs.append(pd.DataFrame([{'Linha': '-', 'Cliente': '-', 'Status': 'Info', 'Detalhe': f'Envio retomado: {retomar} linhas já gravadas anteriormente foram puladas'}]))
+        logs_conf = len(logs)  # logs até aqui descrevem o que já está confirmado no banco
+        for df in _lotes(planilha):
+            if df.empty: continue
+            if feitas < retomar:
+                pular = min(len(df), retomar - feitas)
+                feitas += pular; df = df.iloc[pular:]
+                if df.empty: continue
+            for bloco in ([df.iloc[k:k + commit_a_cada] for k in range(0, len(df), commit_a_cada)] if em_blocos else [df]):
+                lote_ok, lote_ign, lote_logs, ncli, novos = gerar_lote(bloco)
+                if df.attrs.get('arquivo'): lote_logs.insert(0, 'Arquivo', df.attrs['arquivo'])
+                ok += lote_ok; ign += lote_ign; logs.append(lote_logs)
+                if simular: previa.append(pd.DataFrame(novos)); continue
+                if ncli: 
+                    _inserir_em_lotes(session, Cliente, ncli)
+                    marcar_alteracao(session, 'clientes')
+                if novos:
+                    # INSERT do Core não passa pelo before_flush: a revisão é carimbada aqui
+                    rev = revisao_da_transacao(session)
+                    for r in novos: r['revisao'] = rev
+                    _inserir_em_lotes(session, Lancamento, novos)
+                gravadas += len(ncli) + len(novos)
+                feitas += len(bloco)
+                if em_blocos:
+                    _salvar_checkpoint(session, chave, 'Entuba', feitas)
+                    session.commit()
+                    ok_conf, ign_conf, feitas_conf, logs_conf = ok, ign, feitas, len(logs)
+        if simular:
+            previa = pd.concat(previa, ignore_index=True).rename(columns=MAPA_SQL_APP) if previa else pd.DataFrame()
+            return ok, ign, previa, pd.concat(logs, ignore_index=True) if logs else pd.DataFrame()
+        # Upload completo: o checkpoint sai (um reenvio posterior é tratado como um envio novo, com as duplicatas ignoradas)
+        if em_blocos: session.execute(CheckpointUpload.__table__.delete().where(CheckpointUpload.__table__.c.chave == chave))
         session.commit()
-        st.cache_data.clear()
+        if gravadas: _registrar_gravacao('Entuba', gravadas, time.perf_counter() - t0)
     except Exception as e: 
         session.rollback()
-        logs.append({'Linha': '-', 'Cliente': '-', 'Status': '❌ Erro Fatal', 'Detalhe': str(e)})
-        return 0, 0, pd.DataFrame(logs)
+        detalhe = str(e)
+        if em_blocos and feitas_conf: detalhe += f' | {feitas_conf} linhas já confirmadas: reenvie o mesmo arquivo para retomar a partir daí'
+        # O que foi desfeito não pode seguir como sucesso no relatório
+        for lg in logs[logs_conf:]:
+            desfeito = lg['Status'].isin(['✅ Sucesso', 'Info'])
+            lg.loc[desfeito, 'Detalhe'] = 'Desfeito pelo erro abaixo: ' + lg.loc[desfeito, 'Detalhe'].astype(str)
+            lg.loc[desfeito, 'Status'] = '❌ Não Gravado'
+        logs.append(pd.DataFrame([{'Linha': '-', 'Cliente': '-', 'Status': '❌ Erro Fatal', 'Detalhe': detalhe}]))
+        return ok_conf, ign_conf, pd.concat(logs, ignore_index=True)
     finally: 
         session.close()
     
-    return ok, ign, pd.DataFrame(logs)
-
-def processar_conciliacao_upload(df):
+    return ok, ign, pd.concat(logs, ignore_index=True) if logs else pd.DataFrame()
+
+# Colunas obrigatórias do extrato da administradora
+COLS_CONCILIACAO = ['grupo', 'cota', 'valor_pago']
+
+def _ordem_vencimento(l):
+    # Vencimento mais antigo primeiro; no mesmo dia, pelo número da parcela
+    return (l.data_previsao is None, l.data_previsao or datetime.min.date(), float('inf') if l.num_parcela is None else l.num_parcela, l.id_lancamento)
+
+# Teto do cache de cotas da conciliação, em parcelas: extrato grande com muitas cotas não segura o ledger inteiro em memória
+LIMITE_CACHE_CONCILIACAO = int(st.secrets.get("RECONCILE_CACHE", os.getenv("RECONCILE_CACHE", 100000)))
+# Só o que a conciliação lê ou marca de cada parcela
+COLS_CANDIDATAS = ['id_lancamento', 'grupo', 'cota', 'parcela', 'num_parcela', 'data_previsao', 'receber_administradora',
+                   'status_recebimento', 'valor_recebido_real', 'data_real_recebimento']
+
+def _carregar_cotas(session, cotas, pares):
+    # Parcelas de todas as cotas (grupo, cota) ainda não carregadas, em poucas consultas; cada lista em ordem de vencimento.
+    # Registros soltos (sem ORM): a baixa é gravada por UPDATE em lote, aqui só se marca o que já foi baixado nesta conciliação.
+    # OR de (grupo = ? AND cota = ?): busca pelo índice (grupo, cota, num_parcela) no MySQL e no SQLite (o IN de tuplas vira varredura no SQLite)
+    # `cotas` é LRU: as pedidas vão para o fim e, acima de LIMITE_CACHE_CONCILIACAO parcelas, saem as usadas há mais tempo (nunca as pedidas
+    # agora). Só se chama entre lotes, depois do UPDATE das baixas: a cota que voltar é relida do banco já com as baixas desta transação.
+    t = Lancamento.__table__
+    pedidas = dict.fromkeys(pares)
+    for p in pedidas:
+        if p in cotas: cotas[p] = cotas.pop(p)
+    faltam = {p: [] for p in pedidas if p not in cotas}
+    chaves = list(faltam); passo = TAMANHO_LOTE_CONSULTA // 2
+    for k in range(0, len(chaves), passo):
+        filtro = or_(*[and_(t.c.grupo == g, t.c.cota == c) for g, c in chaves[k:k + passo]])
+        for r in session.execute(select(*[t.c[n] for n in COLS_CANDIDATAS]).where(filtro)).mappings():
+            # Collation do MySQL pode devolver grafias equivalentes: só entra a chave exata pedida
+            if (r['grupo'], r['cota']) in faltam: faltam[(r['grupo'], r['cota'])].append(SimpleNamespace(**r))
+    for p, lista in faltam.items(): cotas[p] = sorted(lista, key=_ordem_vencimento)
+    total = sum(map(len, cotas.values()))
+    for p in list(cotas):
+        if total <= LIMITE_CACHE_CONCILIACAO: break
+        if p not in pedidas: total -= len(cotas.pop(p))
+
+# Diferença aceita entre o valor do extrato e o esperado da parcela (centavos de arredondamento da administradora)
+TOLERANCIA_CONCILIACAO = 1.00
+
+def _atribuir_por_valor(linhas, pendentes, tolerancia=TOLERANCIA_CONCILIACAO):
+    # Linhas do extrato sem número da parcela (pos, valor) x parcelas pendentes da mesma cota, em O(n log n):
+    # ambas em ordem de valor (parcelas desempatadas pelo vencimento, linhas pela ordem na planilha) e cada linha leva
+    # a parcela livre de menor valor dentro da tolerância. Como toda janela [valor ± tolerância] tem a mesma largura,
+    # esse guloso baixa o maior número possível de linhas, e o resultado não depende da ordem de chegada.
+    ordem_p = sorted(pendentes, key=lambda l: (l.receber_administradora or 0.0, _ordem_vencimento(l)))
+    pares, j = {}, 0
+    for pos, valor in sorted(linhas, key=lambda x: (x[1], x[0])):
+        while j < len(ordem_p) and (ordem_p[j].receber_administradora or 0.0) < valor and abs((ordem_p[j].receber_administradora or 0.0) - valor) > tolerancia: j += 1
+        if j < len(ordem_p) and abs((ordem_p[j].receber_administradora or 0.0) - valor) <= tolerancia:
+            pares[pos] = ordem_p[j]; j += 1
+    return pares
+
+def _confirmar_baixas(session, baixas, pos_baixas, logs):
+    # Grava as baixas; a que o banco recusou (já paga por outra conciliação depois da leitura) volta como "Já Baixado"
+    baixadas = _aplicar_baixas(session, baixas)
+    for b, pos in zip(baixas, pos_baixas):
+        if b['b_id'] not in baixadas:
+            logs[pos].update({'Status': '⚠️ Já Baixado', 'Detalhe': 'Parcela baixada por outra conciliação durante este processamento'})
+    return len(baixadas)
+
+def _aplicadas(baixas, pos_baixas, logs, impressoes):
+    # Registros do histórico das baixas que o banco aceitou; a impressão de cada baixa sai do dicionário (é usada uma vez só)
+    return [{**imp, 'id_lancamento': b['b_id']} for b, pos in zip(baixas, pos_baixas)
+            if (imp := impressoes.pop(pos, None)) and logs[pos]['Status'] == '✅ Sucesso']
+
+def _aplicar_baixas(session, baixas):
+    # Um UPDATE parametrizado por lote. O "!= 'Pago'" no WHERE impede baixar duas vezes a mesma parcela,
+    # inclusive quando outro operador concilia um extrato sobreposto ao mesmo tempo. Devolve os IDs de fato baixados.
+    if not baixas: return set()
+    t = Lancamento.__table__
+    rev = revisao_da_transacao(session)
+    stmt = update(t).where(t.c.id_lancamento == bindparam('b_id'), t.c.status_recebimento != 'Pago').values(
+        status_recebimento='Pago', valor_recebido_real=bindparam('b_valor'), data_real_recebimento=bindparam('b_data'), revisao=rev)
+    feitas = sum(session.execute(stmt, baixas[i:i + TAMANHO_LOTE_ESCRITA]).rowcount for i in range(0, len(baixas), TAMANHO_LOTE_ESCRITA))
+    ids = [b['b_id'] for b in baixas]
+    if feitas == len(ids): return set(ids)
+    # Alguma já estava paga no banco (ou o driver não soma o rowcount do executemany): as nossas levam a revisão desta transação
+    return {i for k in range(0, len(ids), TAMANHO_LOTE_CONSULTA)
+            for i in session.scalars(select(t.c.id_lancamento).where(t.c.id_lancamento.in_(ids[k:k + TAMANHO_LOTE_CONSULTA]), t.c.revisao == rev))}
+
+def _ler_linha_conciliacao(row):
+    # (grupo, cota, valor pago ou None se inválido, número da parcela ou None) de uma linha do extrato
+    g = str(row.get('grupo', '')).replace('.0', '').strip()
+    c = str(row.get('cota', '')).replace('.0', '').strip()
+    try:
+        val_pago = float(row.get('valor_pago', 0))
+        if np.isnan(val_pago): raise ValueError
+    except: val_pago = None
+    # Tenta extrair "1" de "1/60" ou "Parcela 1"
+    try: num_parcela = int(str(row.get('num_parcela', '')).split('/')[0].lower().replace('parcela', '').strip())
+    except: num_parcela = None
+    return g, c, val_pago, num_parcela
+
+def _hash_conciliacao(df, g, c, val_pago, num_parcela, ocorrencias):
+    # Com número, a linha identifica a parcela e vale entre arquivos. Sem número, o mesmo valor pode ser o pagamento
+    # de outro mês: só conta como reenvio dentro do mesmo arquivo (e a n-ésima linha igual é a n-ésima de novo)
+    if val_pago is None: return None
+    if num_parcela: return _hash_linha('Conciliação', g, c, num_parcela, f'{val_pago:.2f}')
+    arq = df.attrs.get('hash_arquivo')
+    if not arq: return None
+    n = ocorrencias[(arq, g, c, val_pago)] = ocorrencias.get((arq, g, c, val_pago), 0) + 1
+    return _hash_linha('Conciliação', g, c, f'{val_pago:.2f}', arq, n)
+
+def processar_conciliacao_upload(planilha, reprocessar=False):
+    # reprocessar=True: não consulta o histórico (linhas já aplicadas voltam a ser conferidas no ledger)
     session = SessionLocal()
-    df.columns = df.columns.str.lower().str.strip()
     
     logs = []
     sucesso_count = 0
-    
-    # 1. Validação de Colunas Obrigatórias
-    cols_obrigatorias = ['grupo', 'cota', 'valor_pago']
-    faltantes = [c for c in cols_obrigatorias if c not in df.columns]
-    if faltantes:
-        return 0, pd.DataFrame([{'Status': 'Erro Crítico', 'Detalhe': f'Colunas faltando no Excel: {faltantes}'}])
+    cotas = {}  # (grupo, cota) -> parcelas: cache limitado (ver _carregar_cotas)
+    sem_numero = {}  # (grupo, cota) -> [(posição no log, valor)]: atribuídas por valor depois de todas as linhas com número
+    impressoes = {}; historico = []; ocorrencias = {}  # posição no log -> registro do histórico (só das linhas a baixar ou reservadas); linhas aplicadas
 
     try:
-        for idx, row in df.iterrows():
-            linha = idx + 2
-            
-            # Normaliza Grupo e Cota
-            g = str(row.get('grupo', '')).replace('.0', '').strip()
-            c = str(row.get('cota', '')).replace('.0', '').strip()
+        t0 = time.perf_counter()
+        for df in _lotes(planilha):
+            df.columns = df.columns.str.lower().str.strip()
             
-            # Tenta ler o Valor
-            try:
-                val_pago = float(row.get('valor_pago', 0))
-            except:
-                logs.append({'Linha': linha, 'Grupo/Cota': f"{g}/{c}", 'Status': '❌ Erro', 'Detalhe': 'Valor Pago inválido (não numérico)'})
-                continue
-
-            # Tenta ler o Número da Parcela (Se houver)
-            num_parcela = None
-            if 'num_parcela' in df.columns:
-                raw_p = str(row.get('num_parcela', ''))
-                # Tenta extrair "1" de "1/60" ou "Parcela 1"
-                try: 
-                    num_parcela = int(raw_p.split('/')[0].lower().replace('parcela', '').strip())
-                except: 
-                    pass
+            # 1. Validação de Colunas Obrigatórias (o primeiro lote já traz o cabeçalho)
+            faltantes = [c for c in COLS_CONCILIACAO if c not in df.columns]
+            if faltantes:
+                return 0, pd.DataFrame([{'Status': 'Erro Crítico', 'Detalhe': f'Colunas faltando no Excel: {faltantes}'}])
+
+            # Impressão digital de cada linha: as já aplicadas por uploads anteriores saem antes de qualquer leitura do ledger
+            lidas = [(idx, *_ler_linha_conciliacao(row)) for idx, row in df.iterrows()]
+            hashes = [_hash_conciliacao(df, *l[1:], ocorrencias) for l in lidas]
+            ja = {} if reprocessar else _ja_importadas(session, 'Conciliação', hashes)
+
+            # Candidatas de todas as cotas do lote de uma vez (as já carregadas mantêm as baixas das linhas anteriores)
+            _carregar_cotas(session, cotas, [(g, c) for (_, g, c, _, _), h in zip(lidas, hashes) if h not in ja])
+
+            inicio = len(logs); baixas = []; pos_baixas = []
+            for (idx, g, c, val_pago, num_parcela), h in zip(lidas, hashes):
+                linha = idx + 2
             
-            # --- BUSCA NO BANCO ---
-            query = session.query(Lancamento).filter(Lancamento.grupo == g, Lancamento.cota == c)
+                if val_pago is None:
+                    logs.append({'Linha': linha, 'Grupo/Cota': f"{g}/{c}", 'Status': '❌ Erro', 'Detalhe': 'Valor Pago inválido (não numérico)'})
+                    continue
+
+                if h in ja:
+                    logs.append({'Linha': linha, 'Grupo/Cota': f"{g}/{c}", **_log_ja_importada(ja[h])})
+                    continue
             
-            # Se tiver número da parcela, filtra por ela
-            if num_parcela:
-                # Busca parcela que começa com o número (ex: "1/100")
-                query = query.filter(Lancamento.parcela.like(f"{num_parcela}/%"))
-            else:
-                # Se não tem parcela no Excel, tenta achar a mais antiga PENDENTE com valor próximo
-                query = query.filter(Lancamento.status_recebimento != 'Pago')
+                # Sem número da parcela: a linha fica reservada no log e entra na atribuição por valor no fim
+                if not num_parcela:
+                    if h: impressoes[len(logs)] = _impressao('Conciliação', df, linha, h)
+                    sem_numero.setdefault((g, c), []).append((len(logs), val_pago))
+                    logs.append({'Linha': linha, 'Grupo/Cota': f"{g}/{c}"})
+                    continue
             
-            lancs_encontrados = query.all()
+                # --- BUSCA NAS PARCELAS JÁ CARREGADAS DA COTA ---
+                lancs_encontrados = [l for l in cotas.get((g, c), []) if l.num_parcela == num_parcela]
             
-            if not lancs_encontrados:
-                logs.append({
-                    'Linha': linha, 
-                    'Grupo/Cota': f"{g}/{c}", 
-                    'Status': '⚠️ Não Encontrado', 
-                    'Detalhe': f'Venda não existe ou parcela {num_parcela} incorreta'
-                })
-                continue
+                if not lancs_encontrados:
+                    logs.append({
+                        'Linha': linha, 
+                        'Grupo/Cota': f"{g}/{c}", 
+                        'Status': '⚠️ Não Encontrado', 
+                        'Detalhe': f'Venda não existe ou parcela {num_parcela} incorreta'
+                    })
+                    continue
             
-            # Pega o primeiro candidato (ou o único)
-            l = lancs_encontrados[0]
+                # Pega o primeiro candidato (ou o único)
+                l = lancs_encontrados[0]
             
-            # --- VALIDAÇÕES DE REGRA DE NEGÓCIO ---
+                # --- VALIDAÇÕES DE REGRA DE NEGÓCIO ---
             
-            # 1. Já está pago?
-            if l.status_recebimento == 'Pago':
-                logs.append({
-                    'Linha': linha, 
-                    'Grupo/Cota': f"{g}/{c}", 
-                    'Parcela': l.parcela,
-                    'Status': '⚠️ Já Baixado', 
-                    'Detalhe': f'Esta parcela já consta como paga em {l.data_real_recebimento or "Data N/A"}'
-                })
-                continue
+                # 1. Já está pago?
+                if l.status_recebimento == 'Pago':
+                    logs.append({
+                        'Linha': linha, 
+                        'Grupo/Cota': f"{g}/{c}", 
+                        'Parcela': l.parcela,
+                        'Status': '⚠️ Já Baixado', 
+                        'Detalhe': f'Esta parcela já consta como paga em {l.data_real_recebimento or "Data N/A"}'
+                    })
+                    continue
                 
-            # 2. Valor bate? (Aceita diferença de centavos até 1.00)
-            diferenca = abs(l.receber_administradora - val_pago)
-            if diferenca > 1.00:
+                # 2. Valor bate? (Aceita diferença de centavos até 1.00)
+                diferenca = abs(l.receber_administradora - val_pago)
+                if diferenca > 1.00:
+                    logs.append({
+                        'Linha': linha, 
+                        'Grupo/Cota': f"{g}/{c}", 
+                        'Parcela': l.parcela,
+                        'Status': '⛔ Divergência', 
+                        'Detalhe': f'Esperado: R$ {l.receber_administradora:.2f} | Veio: R$ {val_pago:.2f}'
+                    })
+                    continue
+            
+                # --- EXECUTA A BAIXA (gravada no UPDATE em lote ao fim do lote da planilha) ---
+                l.status_recebimento = 'Pago'
+                l.valor_recebido_real = val_pago
+                l.data_real_recebimento = datetime.now().date()
+                baixas.append({'b_id': l.id_lancamento, 'b_valor': val_pago, 'b_data': l.data_real_recebimento})
+                pos_baixas.append(len(logs))
+                if h: impressoes[len(logs)] = _impressao('Conciliação', df, linha, h)
+            
+                # Atualiza status do cliente também (opcional, depende da sua regra)
+                # l.status_pgto_cliente = 'Pago' 
+            
                 logs.append({
                     'Linha': linha, 
                     'Grupo/Cota': f"{g}/{c}", 
                     'Parcela': l.parcela,
-                    'Status': '⛔ Divergência', 
-                    'Detalhe': f'Esperado: R$ {l.receber_administradora:.2f} | Veio: R$ {val_pago:.2f}'
+                    'Status': '✅ Sucesso', 
+                    'Detalhe': f'Baixado R$ {val_pago:.2f}'
                 })
-                continue
-            
-            # --- EXECUTA A BAIXA ---
-            l.status_recebimento = 'Pago'
-            l.valor_recebido_real = val_pago
-            l.data_real_recebimento = datetime.now().date()
-            
-            # Atualiza status do cliente também (opcional, depende da sua regra)
-            # l.status_pgto_cliente = 'Pago' 
-            
-            sucesso_count += 1
-            logs.append({
-                'Linha': linha, 
-                'Grupo/Cota': f"{g}/{c}", 
-                'Parcela': l.parcela,
-                'Status': '✅ Sucesso', 
-                'Detalhe': f'Baixado R$ {val_pago:.2f}'
-            })
+            logs[inicio:] = _com_arquivo(df, logs[inicio:])
+
+            sucesso_count += _confirmar_baixas(session, baixas, pos_baixas, logs)
+            historico += _aplicadas(baixas, pos_baixas, logs, impressoes)
+
+        # 2. Linhas sem número da parcela: cada cota de uma vez, contra as pendentes que sobraram das linhas com número
+        # (só 'Pendente': parcela cancelada ou estornada não está em aberto e não recebe baixa por valor).
+        # Em blocos de cotas do tamanho de um lote da planilha, como na passada com número
+        hoje = datetime.now().date(); chaves = list(sem_numero)
+        for k in range(0, len(chaves), TAMANHO_LOTE_PLANILHA):
+            _carregar_cotas(session, cotas, chaves[k:k + TAMANHO_LOTE_PLANILHA])
+            baixas = []; pos_baixas = []
+            for g, c in chaves[k:k + TAMANHO_LOTE_PLANILHA]:
+                linhas_cota = sem_numero.pop((g, c))
+                pendentes = [l for l in cotas[(g, c)] if l.status_recebimento == 'Pendente']
+                pares = _atribuir_por_valor(linhas_cota, pendentes)
+                # A mais antiga que ficou pendente é a referência das linhas que não acharam parcela no valor
+                usadas = {l.id_lancamento for l in pares.values()}
+                sobra = next((l for l in pendentes if l.id_lancamento not in usadas), None)
+                for pos, val_pago in linhas_cota:
+                    l = pares.get(pos)
+                    if l:
+                        l.status_recebimento = 'Pago'; l.valor_recebido_real = val_pago; l.data_real_recebimento = hoje
+                        baixas.append({'b_id': l.id_lancamento, 'b_valor': val_pago, 'b_data': hoje}); pos_baixas.append(pos)
+                        logs[pos].update({'Parcela': l.parcela, 'Status': '✅ Sucesso', 'Detalhe': f'Baixado R$ {val_pago:.2f}'})
+                    elif sobra:
+                        logs[pos].update({'Parcela': sobra.parcela, 'Status': '⛔ Divergência', 'Detalhe': f'Esperado: R$ {sobra.receber_administradora:.2f} | Veio: R$ {val_pago:.2f}'})
+                    else:
+                        logs[pos].update({'Status': '⚠️ Não Encontrado', 'Detalhe': 'Venda não existe ou parcela None incorreta'})
+            sucesso_count += _confirmar_baixas(session, baixas, pos_baixas, logs)
+            historico += _aplicadas(baixas, pos_baixas, logs, impressoes)
 
         if sucesso_count > 0:
+            _gravar_historico(session, historico)
             session.commit()
-            st.cache_data.clear()
+            _registrar_gravacao('Conciliação', sucesso_count, time.perf_counter() - t0)
             
     except Exception as e:
         session.rollback()
@@ -572,162 +1501,190 @@ def processar_conciliacao_upload(df):
 
     return sucesso_count, pd.DataFrame(logs)
 
-def processar_cancelamento_inteligente(df):
-    REGRAS = carregar_regras_dict()
+def _hash_cancelamento(row):
+    # (id_venda, parcela de corte) identifica o cancelamento, em qualquer arquivo
+    id_venda = str(row.get('id_venda', '')).strip()
+    try: return _hash_linha('Cancelamentos', id_venda, int(row.get('parcela_cancelamento'))) if id_venda else None
+    except: return None
+
+def processar_cancelamento_inteligente(planilha, simular=False, reprocessar=False):
+    # simular=True: mesmo relatório, mas sobre cópias soltas das parcelas e sem gravar nada
+    # reprocessar=True: não consulta o histórico (linhas já aplicadas voltam a ser conferidas no ledger)
+    REGRAS = carregar_regras()
     session = SessionLocal()
     
-    # Normaliza Excel
-    df.columns = df.columns.str.lower().str.strip()
-    
     count_alterados = 0
     logs = []
+    vendas = {}; estornos = set(); historico = []
     
     try:
-        for idx, row in df.iterrows():
-            linha_excel = idx + 2
-            id_venda = str(row.get('id_venda', '')).strip()
+        for df in _lotes(planilha):
+            # Normaliza Excel
+            df.columns = df.columns.str.lower().str.strip()
+            
+            # Impressão digital de cada linha: as já aplicadas por uploads anteriores saem antes de qualquer leitura do ledger
+            hashes = {idx: _hash_cancelamento(row) for idx, row in df.iterrows()}
+            ja = {} if reprocessar else _ja_importadas(session, 'Cancelamentos', hashes.values())
             
-            # Validação básica
-            if not id_venda:
-                logs.append({'Linha': linha_excel, 'Venda': '-', 'Status': '❌ Erro', 'Detalhe': 'ID Venda vazio'})
-                continue
+            # Parcelas de todas as vendas do lote de uma vez (as já carregadas mantêm o que linhas anteriores alteraram)
+            ids = [str(v).strip() for v, h in zip(df['id_venda'], hashes.values()) if h not in ja] if 'id_venda' in df.columns else []
+            faltam = [i for i in ids if i and i not in vendas]
+            for i in faltam: vendas[i] = []
+            for l in _buscar_lancamentos(session, 'id_venda', faltam, simular): vendas[l.id_venda].append(l)
+            
+            for idx, row in df.iterrows():
+                linha_excel = idx + 2
+                id_venda = str(row.get('id_venda', '')).strip()
+            
+                # Validação básica
+                if not id_venda:
+                    logs.append({'Linha': linha_excel, 'Venda': '-', 'Status': '❌ Erro', 'Detalhe': 'ID Venda vazio'})
+                    continue
+                
+                try:
+                    parcela_corte = int(row.get('parcela_cancelamento'))
+                except:
+                    logs.append({'Linha': linha_excel, 'Venda': id_venda, 'Status': '❌ Erro', 'Detalhe': 'Parcela inválida (deve ser número)'})
+                    continue
                 
-            try:
-                parcela_corte = int(row.get('parcela_cancelamento'))
-            except:
-                logs.append({'Linha': linha_excel, 'Venda': id_venda, 'Status': '❌ Erro', 'Detalhe': 'Parcela inválida (deve ser número)'})
-                continue
+                h = hashes[idx]
+                if h in ja:
+                    logs.append({'Linha': linha_excel, 'Venda': id_venda, **_log_ja_importada(ja[h])})
+                    continue
             
-            # Busca todos os lançamentos dessa venda
-            lancs = session.query(Lancamento).filter_by(id_venda=id_venda).all()
+                # Busca todos os lançamentos dessa venda
+                lancs = vendas.get(id_venda, [])
             
-            if not lancs:
-                logs.append({'Linha': linha_excel, 'Venda': id_venda, 'Status': '❌ Erro', 'Detalhe': 'Venda não encontrada no banco'})
-                continue
+                if not lancs:
+                    logs.append({'Linha': linha_excel, 'Venda': id_venda, 'Status': '❌ Erro', 'Detalhe': 'Venda não encontrada no banco'})
+                    continue
             
-            # Identifica Regra para cálculo de estorno
-            tipo_cota = lancs[0].tipo_cota
-            regra = REGRAS.get(tipo_cota, {})
-            limite_estorno = regra.get('limite_parcela_estorno', 3)
-            pct_multa = regra.get('pct_estorno', 0.0)
+                # Identifica Regra para cálculo de estorno
+                tipo_cota = lancs[0].tipo_cota
+                regra = REGRAS.get(tipo_cota)
+                limite_estorno = regra.limite_parcela_estorno if regra else 3
+                pct_multa = regra.pct_estorno if regra else 0.0
+                pcts = regra.pcts if regra else ()
             
-            # --- LÓGICA DE VERIFICAÇÃO (JÁ ESTÁ CANCELADO?) ---
-            qtd_futuras = 0
-            qtd_ja_canceladas = 0
+                # --- LÓGICA DE VERIFICAÇÃO (JÁ ESTÁ CANCELADO?) ---
+                qtd_futuras = 0
+                qtd_ja_canceladas = 0
             
-            # Identifica quais parcelas deveriam ser canceladas
-            lancs_futuros = []
-            for l in lancs:
-                # Ignora linha de estorno se já existir
-                if 'EST' in l.id_lancamento: continue
+                # Identifica quais parcelas deveriam ser canceladas
+                lancs_futuros = []
+                for l in lancs:
+                    # Ignora linha de estorno se já existir
+                    if l.is_estorno or l.num_parcela is None: continue
+                    num_parcela = l.num_parcela
                 
-                try: num_parcela = int(l.parcela.split('/')[0])
-                except: continue
-                
-                if num_parcela > parcela_corte:
-                    lancs_futuros.append(l)
-                    qtd_futuras += 1
-                    if l.status_recebimento == 'Cancelado':
-                        qtd_ja_canceladas += 1
+                    if num_parcela > parcela_corte:
+                        lancs_futuros.append(l)
+                        qtd_futuras += 1
+                        if l.status_recebimento == 'Cancelado':
+                            qtd_ja_canceladas += 1
             
-            # SE TODAS AS FUTURAS JÁ ESTÃO CANCELADAS, IGNORA
-            if qtd_futuras > 0 and qtd_futuras == qtd_ja_canceladas:
-                logs.append({
-                    'Linha': linha_excel, 
-                    'Venda': id_venda, 
-                    'Status': '⚠️ Ignorado', 
-                    'Detalhe': f'Venda já cancelada a partir da parc {parcela_corte}'
-                })
-                continue
+                # SE TODAS AS FUTURAS JÁ ESTÃO CANCELADAS, IGNORA
+                if qtd_futuras > 0 and qtd_futuras == qtd_ja_canceladas:
+                    logs.append({
+                        'Linha': linha_excel, 
+                        'Venda': id_venda, 
+                        'Status': '⚠️ Ignorado', 
+                        'Detalhe': f'Venda já cancelada a partir da parc {parcela_corte}'
+                    })
+                    continue
             
-            if qtd_futuras == 0:
-                logs.append({
-                    'Linha': linha_excel, 
-                    'Venda': id_venda, 
-                    'Status': '⚠️ Aviso', 
-                    'Detalhe': 'Nenhuma parcela futura encontrada para cancelar'
-                })
-                continue
-
-            # --- EXECUTA O CANCELAMENTO ---
-            for l in lancs_futuros:
-                l.status_recebimento = 'Cancelado'
-                l.status_pgto_cliente = 'Cancelado'
-                l.receber_administradora = 0.0
-                l.pagar_vendedor = 0.0
-                l.pagar_supervisor = 0.0
-                l.pagar_gerente = 0.0
-                l.liquido_caixa = 0.0
-                if hasattr(l, 'valor_cliente'):
-                    l.valor_cliente = 0.0
+                if qtd_futuras == 0:
+                    logs.append({
+                        'Linha': linha_excel, 
+                        'Venda': id_venda, 
+                        'Status': '⚠️ Aviso', 
+                        'Detalhe': 'Nenhuma parcela futura encontrada para cancelar'
+                    })
+                    continue
+
+                # --- EXECUTA O CANCELAMENTO ---
+                for l in lancs_futuros:
+                    l.status_recebimento = 'Cancelado'
+                    l.status_pgto_cliente = 'Cancelado'
+                    l.receber_administradora = 0.0
+                    l.pagar_vendedor = 0.0
+                    l.pagar_supervisor = 0.0
+                    l.pagar_gerente = 0.0
+                    l.liquido_caixa = 0.0
+                    if hasattr(l, 'valor_cliente'):
+                        l.valor_cliente = 0.0
             
-            msg_sucesso = f"{len(lancs_futuros)} parcelas canceladas."
+                msg_sucesso = f"{len(lancs_futuros)} parcelas canceladas."
+                tocados = [l.id_lancamento for l in lancs_futuros]
             
-            # --- CÁLCULO DE ESTORNO (MULTA) ---
-            # Só gera estorno se o cancelamento for precoce (ex: antes da parcela 3)
-            if parcela_corte <= limite_estorno and pct_multa > 0:
-                id_estorno = f"{id_venda}_EST"
+                # --- CÁLCULO DE ESTORNO (MULTA) ---
+                # Só gera estorno se o cancelamento for precoce (ex: antes da parcela 3)
+                if parcela_corte <= limite_estorno and pct_multa > 0:
+                    id_estorno = f"{id_venda}_EST"
                 
-                # Verifica se estorno já existe
-                estorno_existente = session.query(Lancamento).get(id_estorno)
+                    # Verifica se estorno já existe (no banco ou gerado por uma linha anterior desta planilha)
+                    estorno_existente = id_estorno in estornos or any(l.id_lancamento == id_estorno for l in lancs)
                 
-                if not estorno_existente:
-                    # Calcula crédito base (Engenharia reversa da comissão recebida)
-                    credito_estimado = 0.0
-                    for l in lancs:
-                        if l.receber_administradora > 0 and 'EST' not in l.id_lancamento:
-                            try:
-                                idx = int(l.parcela.split('/')[0]) - 1
-                                if idx < len(regra['pcts']):
-                                    # Valor / % = Crédito
-                                    credito_estimado = l.receber_administradora / (regra['pcts'][idx] / 100)
-                                    break
-                            except: pass
+                    if not estorno_existente:
+                        # Calcula crédito base (Engenharia reversa da comissão recebida)
+                        credito_estimado = 0.0
+                        for l in lancs:
+                            if l.receber_administradora > 0 and not l.is_estorno and l.num_parcela is not None:
+                                try:
+                                    idx = l.num_parcela - 1
+                                    if idx < len(pcts):
+                                        # Valor / % = Crédito
+                                        credito_estimado = l.receber_administradora / (pcts[idx] / 100)
+                                        break
+                                except: pass
                     
-                    if credito_estimado > 0:
-                        valor_multa = -1 * (credito_estimado * (pct_multa / 100))
+                        if credito_estimado > 0:
+                            valor_multa = -1 * (credito_estimado * (pct_multa / 100))
                         
-                        estorno_obj = Lancamento(
-                            id_lancamento=id_estorno,
-                            id_venda=id_venda,
-                            administradora=lancs[0].administradora,
-                            grupo=lancs[0].grupo,
-                            cota=lancs[0].cota,
-                            tipo_cota=tipo_cota,
-                            parcela="Estorno",
-                            data_previsao=datetime.now().date(),
-                            id_cliente=lancs[0].id_cliente,
-                            cliente=lancs[0].cliente,
-                            id_vendedor=lancs[0].id_vendedor,
-                            vendedor=lancs[0].vendedor,
-                            id_gerente=lancs[0].id_gerente,
-                            gerente=lancs[0].gerente,
-                            valor_cliente=0.0,
-                            receber_administradora=valor_multa,
-                            pagar_vendedor=0,
-                            pagar_gerente=0,
-                            pagar_supervisor=0,
-                            liquido_caixa=valor_multa,
-                            status_recebimento='Estorno',
-                            status_pgto_cliente='Estorno',
-                            status_pgto_vendedor='Isento',
-                            status_pgto_supervisor='Isento',
-                            status_pgto_gerente='Isento'
-                        )
-                        session.add(estorno_obj)
-                        msg_sucesso += f" Multa de {valor_multa:.2f} gerada."
+                            estorno_obj = Lancamento(
+                                id_lancamento=id_estorno,
+                                id_venda=id_venda,
+                                administradora=lancs[0].administradora,
+                                grupo=lancs[0].grupo,
+                                cota=lancs[0].cota,
+                                tipo_cota=tipo_cota,
+                                parcela="Estorno",
+                                data_previsao=datetime.now().date(),
+                                id_cliente=lancs[0].id_cliente,
+                                cliente=lancs[0].cliente,
+                                id_vendedor=lancs[0].id_vendedor,
+                                vendedor=lancs[0].vendedor,
+                                id_gerente=lancs[0].id_gerente,
+                                gerente=lancs[0].gerente,
+                                valor_cliente=0.0,
+                                receber_administradora=valor_multa,
+                                pagar_vendedor=0,
+                                pagar_gerente=0,
+                                pagar_supervisor=0,
+                                liquido_caixa=valor_multa,
+                                status_recebimento='Estorno',
+                                status_pgto_cliente='Estorno',
+                                status_pgto_vendedor='Isento',
+                                status_pgto_supervisor='Isento',
+                                status_pgto_gerente='Isento'
+                            )
+                            if not simular: session.add(estorno_obj)
+                            estornos.add(id_estorno)
+                            tocados.append(id_estorno)
+                            msg_sucesso += f" Multa de {valor_multa:.2f} gerada."
             
-            logs.append({
-                'Linha': linha_excel, 
-                'Venda': id_venda, 
-                'Status': '✅ Sucesso', 
-                'Detalhe': msg_sucesso
-            })
-            count_alterados += 1
+                historico += [{**_impressao('Cancelamentos', df, linha_excel, h), 'id_lancamento': i} for i in tocados]
+                logs.append({
+                    'Linha': linha_excel, 
+                    'Venda': id_venda, 
+                    'Status': '✅ Sucesso', 
+                    'Detalhe': msg_sucesso
+                })
+                count_alterados += 1
 
-        if count_alterados > 0:
+        if count_alterados > 0 and not simular:
+            _gravar_historico(session, historico)
             session.commit()
-            st.cache_data.clear()
             
     except Exception as e:
         session.rollback()
@@ -738,169 +1695,176 @@ def processar_cancelamento_inteligente(df):
 
     return count_alterados, pd.DataFrame(logs)
 
-def processar_edicao_lote(df):
+def processar_edicao_lote(planilha, simular=False):
+    # simular=True: mesmo relatório, mas sobre cópias soltas dos lançamentos e sem gravar nada
     session = SessionLocal()
     count_alterados = 0
     logs = [] 
     
-    # Normaliza colunas
-    df.columns = df.columns.str.lower().str.strip()
-    
-    # Carrega lookups
-    users = {u.id_usuario: u for u in session.query(Usuario).all()}
+    try:
+        # Carrega lookups
+        users = {u.id_usuario: u for u in session.query(Usuario).all()}
     
-    # Lista Negra (Campos que não podem mudar nunca)
-    COLUNAS_PROIBIDAS = ['administradora', 'parcela', 'tipo_cota', 'id_venda', 'grupo', 'cota', 'id_lancamento']
+        # Lista Negra (Campos que não podem mudar nunca)
+        COLUNAS_PROIBIDAS = ['administradora', 'parcela', 'tipo_cota', 'id_venda', 'grupo', 'cota', 'id_lancamento', *COLS_INTERNAS]
+        carregados = {}
 
-    for _, row in df.iterrows():
-        # Identifica ID
-        id_lanc = str(row.get('id_lancamento', '')).strip()
-        if not id_lanc: continue
+        for df in _lotes(planilha):
+            # Normaliza colunas
+            df.columns = df.columns.str.lower().str.strip()
+        
+            # Lançamentos do lote numa consulta só (os já carregados mantêm o que linhas anteriores alteraram)
+            ids = [str(v).strip() for v in df['id_lancamento']] if 'id_lancamento' in df.columns else []
+            carregados.update({l.id_lancamento: l for l in _buscar_lancamentos(session, 'id_lancamento', [i for i in ids if i and i not in carregados], simular)})
+        
+            for _, row in df.iterrows():
+                # Identifica ID
+                id_lanc = str(row.get('id_lancamento', '')).strip()
+                if not id_lanc: continue
         
-        l = session.query(Lancamento).get(id_lanc)
+                l = carregados.get(id_lanc)
         
-        if not l:
-            logs.append({'ID': id_lanc, 'Status': '❌ Erro', 'Detalhe': 'ID não encontrado no banco'})
-            continue
+                if not l:
+                    logs.append({'ID': id_lanc, 'Status': '❌ Erro', 'Detalhe': 'ID não encontrado no banco'})
+                    continue
             
-        recalc_financeiro = False
+                recalc_financeiro = False
         
-        for col in df.columns:
-            # Pula coluna de ID e colunas que não existem no modelo
-            if col == 'id_lancamento' or not hasattr(l, col): 
-                continue 
+                for col in df.columns:
+                    # Pula coluna de ID e colunas que não existem no modelo
+                    if col == 'id_lancamento' or not hasattr(l, col): 
+                        continue 
             
-            val_novo = row[col]
-            if pd.isna(val_novo): continue # Pula vazios
+                    val_novo = row[col]
+                    if pd.isna(val_novo): continue # Pula vazios
             
-            s_val_novo = str(val_novo).replace('.0', '').strip()
-            val_atual = str(getattr(l, col) or '').strip()
+                    s_val_novo = str(val_novo).replace('.0', '').strip()
+                    val_atual = str(getattr(l, col) or '').strip()
             
-            # CENÁRIO 1: VALOR IDÊNTICO (IGNORA)
-            if val_atual == s_val_novo:
-                logs.append({
-                    'ID': id_lanc,
-                    'Status': '⚠️ Ignorado',
-                    'Detalhe': f"Campo '{col}' já é '{val_atual}'"
-                })
-                continue
-
-            # CENÁRIO 2: VALOR DIFERENTE (TENTA ALTERAR)
+                    # CENÁRIO 1: VALOR IDÊNTICO (IGNORA)
+                    if val_atual == s_val_novo:
+                        logs.append({
+                            'ID': id_lanc,
+                            'Status': '⚠️ Ignorado',
+                            'Detalhe': f"Campo '{col}' já é '{val_atual}'"
+                        })
+                        continue
+
+                    # CENÁRIO 2: VALOR DIFERENTE (TENTA ALTERAR)
             
-            # Trava Estrutural
-            if col in COLUNAS_PROIBIDAS:
-                logs.append({
-                    'ID': id_lanc, 
-                    'Status': '⛔ Bloqueado', 
-                    'Detalhe': f"Campo '{col}' é estrutural (blindado)"
-                })
-                continue
-
-            # Travas Financeiras
-            if col == 'id_vendedor' and l.status_pgto_vendedor == 'Pago':
-                logs.append({'ID': id_lanc, 'Status': '⛔ Bloqueado', 'Detalhe': 'Comissão Vendedor já paga'})
-                continue
+                    # Trava Estrutural
+                    if col in COLUNAS_PROIBIDAS:
+                        logs.append({
+                            'ID': id_lanc, 
+                            'Status': '⛔ Bloqueado', 
+                            'Detalhe': f"Campo '{col}' é estrutural (blindado)"
+                        })
+                        continue
+
+                    # Travas Financeiras
+                    if col == 'id_vendedor' and l.status_pgto_vendedor == 'Pago':
+                        logs.append({'ID': id_lanc, 'Status': '⛔ Bloqueado', 'Detalhe': 'Comissão Vendedor já paga'})
+                        continue
                 
-            if col == 'id_gerente' and l.status_pgto_gerente == 'Pago':
-                logs.append({'ID': id_lanc, 'Status': '⛔ Bloqueado', 'Detalhe': 'Comissão Gerente já paga'})
-                continue
+                    if col == 'id_gerente' and l.status_pgto_gerente == 'Pago':
+                        logs.append({'ID': id_lanc, 'Status': '⛔ Bloqueado', 'Detalhe': 'Comissão Gerente já paga'})
+                        continue
 
-            if col == 'receber_administradora' and l.status_recebimento == 'Pago':
-                 logs.append({'ID': id_lanc, 'Status': '⛔ Bloqueado', 'Detalhe': 'Recebimento já baixado'})
-                 continue
+                    if col == 'receber_administradora' and l.status_recebimento == 'Pago':
+                         logs.append({'ID': id_lanc, 'Status': '⛔ Bloqueado', 'Detalhe': 'Recebimento já baixado'})
+                         continue
 
-            # APLICA ALTERAÇÃO
-            setattr(l, col, s_val_novo)
-            count_alterados += 1
+                    # APLICA ALTERAÇÃO
+                    setattr(l, col, s_val_novo)
+                    count_alterados += 1
             
-            logs.append({
-                'ID': id_lanc, 
-                'Status': '✅ Sucesso', 
-                'Detalhe': f"{col}: {val_atual} -> {s_val_novo}"
-            })
+                    logs.append({
+                        'ID': id_lanc, 
+                        'Status': '✅ Sucesso', 
+                        'Detalhe': f"{col}: {val_atual} -> {s_val_novo}"
+                    })
             
-            # Flags de Recálculo
-            if col in ['id_vendedor', 'id_gerente', 'receber_administradora']:
-                recalc_financeiro = True
-
-        # Recálculo de comissão
-        if recalc_financeiro:
-            tv = users[l.id_vendedor].taxa_vendedor if l.id_vendedor and l.id_vendedor in users else 0.20
-            ts = users[l.id_supervisor].taxa_supervisor if l.id_supervisor and l.id_supervisor in users else 0.10
-            tg = users[l.id_gerente].taxa_gerencia if l.id_gerente and l.id_gerente in users else 0.10
+                    # Flags de Recálculo
+                    if col in ['id_vendedor', 'id_gerente', 'receber_administradora']:
+                        recalc_financeiro = True
+
+                # Recálculo de comissão
+                if recalc_financeiro:
+                    tv = users[l.id_vendedor].taxa_vendedor if l.id_vendedor and l.id_vendedor in users else 0.20
+                    ts = users[l.id_supervisor].taxa_supervisor if l.id_supervisor and l.id_supervisor in users else 0.10
+                    tg = users[l.id_gerente].taxa_gerencia if l.id_gerente and l.id_gerente in users else 0.10
             
-            try: r = float(l.receber_administradora)
-            except: r = 0.0
+                    try: r = float(l.receber_administradora)
+                    except: r = 0.0
             
-            l.pagar_vendedor = r * tv
-            l.pagar_supervisor = r * ts if l.id_supervisor else 0.0
-            l.pagar_gerente = r * tg if l.id_gerente else 0.0
-            l.liquido_caixa = r - l.pagar_vendedor - l.pagar_supervisor - l.pagar_gerente
-
-            # --- NOVO: REAJUSTE DE STATUS AUTOMÁTICO ---
-            if not l.id_supervisor: l.status_pgto_supervisor = 'Isento'
-            elif l.status_pgto_supervisor == 'Isento': l.status_pgto_supervisor = 'Pendente'
+                    l.pagar_vendedor = r * tv
+                    l.pagar_supervisor = r * ts if l.id_supervisor else 0.0
+                    l.pagar_gerente = r * tg if l.id_gerente else 0.0
+                    l.liquido_caixa = r - l.pagar_vendedor - l.pagar_supervisor - l.pagar_gerente
+
+                    # --- NOVO: REAJUSTE DE STATUS AUTOMÁTICO ---
+                    if not l.id_supervisor: l.status_pgto_supervisor = 'Isento'
+                    elif l.status_pgto_supervisor == 'Isento': l.status_pgto_supervisor = 'Pendente'
             
-            if not l.id_gerente: l.status_pgto_gerente = 'Isento'
-            elif l.status_pgto_gerente == 'Isento': l.status_pgto_gerente = 'Pendente'
+                    if not l.id_gerente: l.status_pgto_gerente = 'Isento'
+                    elif l.status_pgto_gerente == 'Isento': l.status_pgto_gerente = 'Pendente'
 
-    if count_alterados > 0:
-        try:
+        if count_alterados > 0 and not simular:
             session.commit()
-            st.cache_data.clear()
-        except Exception as e:
-            session.rollback()
-            logs.append({'ID': 'Geral', 'Status': '❌ Erro Crítico', 'Detalhe': str(e)})
-            return 0, pd.DataFrame(logs)
-            
-    session.close()
+    except Exception as e:
+        session.rollback()
+        logs.append({'ID': 'Geral', 'Status': '❌ Erro Crítico', 'Detalhe': str(e)})
+        return 0, pd.DataFrame(logs)
+    finally:
+        session.close()
+
     return count_alterados, pd.DataFrame(logs)
 
-def processar_exclusao_lote(df):
+def processar_exclusao_lote(planilha):
     session = SessionLocal()
     count = 0
     logs = []
     
-    # Normaliza
-    df.columns = df.columns.str.lower().str.strip()
-    
-    # Assume que o ID está na primeira coluna ou numa coluna chamada 'id_lancamento'
-    col_id = 'id_lancamento' if 'id_lancamento' in df.columns else df.columns[0]
-    
-    for _, row in df.iterrows():
-        id_alvo = str(row[col_id]).strip()
+    try:
+        for df in _lotes(planilha):
+            # Normaliza
+            df.columns = df.columns.str.lower().str.strip()
         
-        # Tenta achar para excluir
-        l = session.query(Lancamento).get(id_alvo)
+            # Assume que o ID está na primeira coluna ou numa coluna chamada 'id_lancamento'
+            col_id = 'id_lancamento' if 'id_lancamento' in df.columns else df.columns[0]
         
-        if l:
-            # Verifica se já está pago (Trava de Segurança opcional, mas recomendada)
-            if l.status_recebimento == 'Pago' or l.status_pgto_vendedor == 'Pago':
-                logs.append({'ID': id_alvo, 'Status': '⛔ Bloqueado', 'Detalhe': 'Registro possui valores pagos/recebidos'})
-            else:
-                session.delete(l)
-                logs.append({'ID': id_alvo, 'Status': '🗑️ Excluído', 'Detalhe': 'Removido com sucesso'})
-                count += 1
-        else:
-            logs.append({'ID': id_alvo, 'Status': '⚠️ Ignorado', 'Detalhe': 'ID não encontrado'})
-
-    if count > 0:
-        try:
+            for _, row in df.iterrows():
+                id_alvo = str(row[col_id]).strip()
+        
+                # Tenta achar para excluir
+                l = session.query(Lancamento).get(id_alvo)
+        
+                if l:
+                    # Verifica se já está pago (Trava de Segurança opcional, mas recomendada)
+                    if l.status_recebimento == 'Pago' or l.status_pgto_vendedor == 'Pago':
+                        logs.append({'ID': id_alvo, 'Status': '⛔ Bloqueado', 'Detalhe': 'Registro possui valores pagos/recebidos'})
+                    else:
+                        session.delete(l)
+                        logs.append({'ID': id_alvo, 'Status': '🗑️ Excluído', 'Detalhe': 'Removido com sucesso'})
+                        count += 1
+                else:
+                    logs.append({'ID': id_alvo, 'Status': '⚠️ Ignorado', 'Detalhe': 'ID não encontrado'})
+
+        if count > 0:
             session.commit()
-            st.cache_data.clear()
-        except Exception as e:
-            session.rollback()
-            return 0, pd.DataFrame([{'ID': 'Erro', 'Status': 'Crítico', 'Detalhe': str(e)}])
-            
-    session.close()
+    except Exception as e:
+        session.rollback()
+        return 0, pd.DataFrame([{'ID': 'Erro', 'Status': 'Crítico', 'Detalhe': str(e)}])
+    finally:
+        session.close()
+
     return count, pd.DataFrame(logs)
 
 def alterar_status_cliente_lote(ids, stt):
     session = SessionLocal()
     try:
-        session.query(Lancamento).filter(Lancamento.id_lancamento.in_(ids)).update({Lancamento.status_pgto_cliente: stt}, synchronize_session=False)
+        session.query(Lancamento).filter(Lancamento.id_lancamento.in_(ids)).update({Lancamento.status_pgto_cliente: stt, Lancamento.revisao: revisao_da_transacao(session)}, synchronize_session=False)
         session.commit()
-        st.cache_data.clear()
         return len(ids), "OK"
     except Exception as e: session.rollback(); return 0, str(e)
     finally: session.close()
@@ -916,7 +1880,6 @@ def processar_baixa_comissoes_lote(lista):
                 else: l.status_pgto_gerente = a['status']
                 c+=1
         session.commit()
-        st.cache_data.clear()
         return c, "OK"
     except Exception as e: session.rollback(); return 0, str(e)
     finally: session.close()
@@ -932,8 +1895,8 @@ def alterar_senha_usuario(id_user, nova_senha):
         novo_hash = gerar_hash(nova_senha)
         usuario.password_hash = novo_hash
         
+        marcar_alteracao(session, 'usuarios')
         session.commit()
-        st.cache_data.clear()
         return True, f"Senha de {usuario.nome_completo} alterada com sucesso!"
     except Exception as e:
         session.rollback()
@@ -972,8 +1935,8 @@ def atualizar_vinculo_usuario(id_u, id_sup, id_ger, tv, ts, tg):
             for vend in vendedores_abaixo:
                 vend.id_gerente = id_ger 
                 
+        marcar_alteracao(session, 'usuarios')
         session.commit()
-        st.cache_data.clear()
         return True, f"✅ Cadastro de {usuario.nome_completo} atualizado com sucesso!"
     except Exception as e: 
         session.rollback()
@@ -1001,8 +1964,8 @@ def enviar_venda_aprovacao(id_vendedor, id_gerente, cliente, adm, produto, credi
         # O Pandas usa o seu motor para criar a tabela sozinho e inserir os dados!
         nova_venda.to_sql('vendas_pendentes', con=engine, if_exists='append', index=False)
         
-        # Limpa o cache para a aba da Diretoria atualizar na hora
-        st.cache_data.clear()
+        # Avisa a aba da Diretoria (só o cache da fila de vendas é refeito)
+        marcar_alteracao(session, 'vendas_pendentes'); session.commit()
         return True, "Venda enviada para análise da diretoria!"
     except Exception as e:
         return False, f"Erro ao enviar: {e}"
@@ -1027,7 +1990,7 @@ def enviar_venda_aprovacao(id_vendedor, id_gerente, cliente, adm, produto, credi
         
         engine = session.get_bind()
         nova_venda.to_sql('vendas_pendentes', con=engine, if_exists='append', index=False)
-        st.cache_data.clear()
+        marcar_alteracao(session, 'vendas_pendentes'); session.commit()
         return True, "Proposta salva na sua gaveta de rascunhos!"
     except Exception as e:
         return False, f"Erro ao salvar rascunho: {e}"
@@ -1048,7 +2011,7 @@ def completar_e_enviar_aprovacao(data_solicitacao, cliente, grupo, cota, data_pr
             "dia_vencimento": int(dia_vencimento),  # <--- ATUALIZANDO O BANCO
             "data": data_solicitacao, "cliente": cliente
         })
-        session.commit(); st.cache_data.clear()
+        marcar_alteracao(session, 'vendas_pendentes'); session.commit()
         return True, "Venda enviada para aprovação do Backoffice!"
     except ValueError: return False, "⚠️ Erro: O Número do Grupo, Cota e Vencimento devem conter apenas números!"
     except Exception as e: session.rollback(); return False, f"Erro ao enviar venda: {e}"
@@ -1078,7 +2041,7 @@ def salvar_proposta_rascunho(id_vendedor, id_supervisor, id_gerente, cliente, ad
         
         engine = session.get_bind()
         nova_venda.to_sql('vendas_pendentes', con=engine, if_exists='append', index=False)
-        st.cache_data.clear()
+        marcar_alteracao(session, 'vendas_pendentes'); session.commit()
         return True, "Proposta salva na sua gaveta de rascunhos!"
     except Exception as e:
         return False, f"Erro ao salvar rascunho: {e}"
@@ -1124,9 +2087,8 @@ def processar_decisao_venda(data_solicitacao, cliente, decisao):
 
         query_update = text("UPDATE vendas_pendentes SET status_aprovacao = :decisao WHERE Data_Solicitacao = :data AND cliente = :cliente")
         session.execute(query_update, {"decisao": decisao, "data": data_solicitacao, "cliente": cliente})
+        marcar_alteracao(session, 'vendas_pendentes')
         session.commit()
-            
-        st.cache_data.clear()
         return True, f"Venda {decisao.lower()} com sucesso!", q_ok, q_ig, log_entuba
         
     except Exception as e:
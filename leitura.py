@@ -0,0 +1,145 @@
+# leitura.py
+# Leitura pura de planilhas e extratos (sem Streamlit nem banco): importada pelo backend e pelos processos do pool de upload
+import pandas as pd
+import numpy as np
+import hashlib
+import time
+import io
+import csv
+import openpyxl
+
+# Linhas por lote quando o chamador não informa (o backend passa o UPLOAD_CHUNK configurado)
+TAMANHO_LOTE = 5000
+
+# Textos que o pd.read_excel trata como célula vazia (na_values padrão do pandas)
+VAZIOS_EXCEL = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+def _celula(v):
+    # Mesma conversão do pd.read_excel: célula vazia/erro é ausente e número inteiro gravado como float vira int
+    if v is None or (isinstance(v, str) and v in VAZIOS_EXCEL): return np.nan
+    if isinstance(v, float) and v.is_integer(): return int(v)
+    return v
+
+def _cabecalho(valores):
+    # Nomes como o read_excel: coluna sem título vira "Unnamed: n" e repetidas ganham ".1", ".2"...
+    nomes, vistos = [], {}
+    for i, v in enumerate(valores):
+        nome = f'Unnamed: {i}' if v is None or str(v).strip() == '' else str(v)
+        if nome in vistos: vistos[nome] += 1; nome = f'{nome}.{vistos[nome]}'
+        else: vistos[nome] = 0
+        nomes.append(nome)
+    return nomes
+
+def ler_planilha_em_lotes(arquivo, progresso=None, tamanho=TAMANHO_LOTE):
+    # Lê o .xlsx em modo somente leitura do openpyxl e entrega DataFrames de até `tamanho` linhas.
+    # O índice segue a linha do Excel (linha - 2), então os logs apontam a mesma linha que antes; linhas em branco são puladas.
+    # Colunas ficam como objeto: o tipo não pode depender de qual lote a linha caiu (3 continua 3, e não 3.0 num lote com vazios).
+    # progresso(linhas, total_estimado, segundos) é chamado a cada lote já consumido pelo processador.
+    identidade = _identidade(arquivo)
+    wb = openpyxl.load_workbook(arquivo, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        linhas = ws.iter_rows(values_only=True)
+        cab = next(linhas, None)
+        if cab is None: return
+        colunas = _cabecalho(cab); nc = len(colunas)
+        total = max((ws.max_row or 0) - 1, 0)
+        t0 = time.perf_counter(); feitas = 0; lote = []; indices = []
+        for n, valores in enumerate(linhas):
+            if all(v is None or v == '' for v in valores): continue
+            lote.append([_celula(v) for v in valores[:nc]] + [np.nan] * (nc - len(valores))); indices.append(n)
+            if len(lote) < tamanho: continue
+            df = pd.DataFrame(lote, columns=colunas, index=indices, dtype=object); df.attrs.update(identidade)
+            yield df
+            feitas += len(lote); lote = []; indices = []
+            if progresso: progresso(feitas, max(total, feitas), time.perf_counter() - t0)
+        if lote or not feitas:
+            df = pd.DataFrame(lote, columns=colunas, index=pd.Index(indices, dtype='int64'), dtype=object); df.attrs.update(identidade)
+            yield df
+            feitas += len(lote)
+        if progresso: progresso(feitas, feitas, time.perf_counter() - t0)
+    finally:
+        wb.close()
+
+def _identidade(arquivo):
+    # Hash e nome do arquivo, levados em df.attrs por cada lote até o histórico de importações
+    return {'hash_arquivo': hash_arquivo(arquivo) if hasattr(arquivo, 'read') else None, 'nome_arquivo': getattr(arquivo, 'name', None)}
+
+def hash_arquivo(arquivo):
+    # sha256 do arquivo lido em blocos; volta ao início para a leitura em lotes
+    h = hashlib.sha256(); arquivo.seek(0)
+    for bloco in iter(lambda: arquivo.read(1 << 20), b''): h.update(bloco)
+    arquivo.seek(0)
+    return h.hexdigest()
+
+# --- EXTRATOS EM CSV / LARGURA FIXA ---
+EXTENSOES_TEXTO = ('.csv', '.txt')
+
+def eh_extrato_texto(nome):
+    return str(nome).lower().endswith(EXTENSOES_TEXTO)
+
+def _separador(arquivo, encoding):
+    # Perfil sem separador: deduz pelas primeiras linhas inteiras do arquivo
+    amostra = arquivo.read(65536).decode(encoding, errors='ignore'); arquivo.seek(0)
+    try: return csv.Sniffer().sniff('\n'.join(amostra.splitlines()[:20]), delimiters=';,|\t').delimiter
+    except csv.Error: return ','
+
+def _normalizar_extrato(df, perfil):
+    # Texto do extrato -> o que a conciliação espera: grupo/cota sem zeros à esquerda (como a célula numérica do Excel)
+    # e valor numérico; valor que não é número segue como veio e cai em "Valor Pago inválido"
+    for col in ('grupo', 'cota'):
+        if col not in df.columns: continue
+        s = df[col].str.strip()
+        df[col] = s.where(~s.str.fullmatch(r'\d+', na=False), s.str.lstrip('0').replace('', '0'))
+    if 'valor_pago' in df.columns:
+        s = df['valor_pago'].str.replace(r'[R$\s]', '', regex=True)
+        if perfil.get('milhar'): s = s.str.replace(perfil['milhar'], '', regex=False)
+        if perfil.get('decimal', '.') != '.': s = s.str.replace(perfil['decimal'], '.', regex=False)
+        v = pd.to_numeric(s, errors='coerce') / 10 ** perfil.get('casas_implicitas', 0)
+        df['valor_pago'] = v.astype(object).where(v.notna(), df['valor_pago'])
+    return df
+
+def ler_extrato_em_lotes(arquivo, perfil, progresso=None, tamanho=TAMANHO_LOTE):
+    # Lê o extrato .csv/.txt em fluxo (chunksize do pandas) e entrega DataFrames de até `tamanho` linhas já com as colunas da conciliação.
+    # perfil: dicionário (o backend resolve o nome em PERFIS_EXTRATO). O índice segue a linha do arquivo (linha - 2), como em ler_planilha_em_lotes; o total do progresso é estimado pelos bytes já lidos.
+    encoding = perfil.get('encoding', 'utf-8-sig')
+    pular = int(perfil.get('pular', 0))
+    identidade = _identidade(arquivo)
+    arquivo.seek(0, 2); total_bytes = arquivo.tell(); arquivo.seek(0)
+    if perfil.get('formato') == 'fixo':
+        campos = dict(perfil['campos'])
+        leitor = pd.read_fwf(arquivo, colspecs=[tuple(v) for v in campos.values()], names=list(campos), header=None, skiprows=pular,
+                             dtype=str, encoding=encoding, chunksize=tamanho)
+        deslocamento = pular - 1
+    else:
+        fontes = {str(k).strip().lower(): v for k, v in dict(perfil.get('colunas', {})).items()}
+        leitor = pd.read_csv(arquivo, sep=perfil.get('separador') or _separador(arquivo, encoding), skiprows=pular, dtype=str,
+                             encoding=encoding, usecols=(lambda c: c.strip().lower() in fontes) if fontes else None, chunksize=tamanho)
+        deslocamento = pular
+    t0 = time.perf_counter(); feitas = 0
+    with leitor:
+        for df in leitor:
+            if perfil.get('formato') != 'fixo':
+                df.columns = df.columns.str.strip().str.lower()
+                if fontes: df = df.rename(columns=fontes)
+            df.index = df.index + deslocamento
+            df = _normalizar_extrato(df.astype(object), perfil); df.attrs.update(identidade)
+            yield df
+            feitas += len(df)
+            if progresso:
+                lidos = arquivo.tell()
+                progresso(feitas, max(feitas, round(feitas * total_bytes / lidos)) if lidos else feitas, time.perf_counter() - t0)
+    if progresso: progresso(feitas, feitas, time.perf_counter() - t0)
+
+# --- UPLOAD DE VÁRIOS ARQUIVOS ---
+def ler_arquivo(nome, dados, obrigatorias, perfil=None, tamanho=TAMANHO_LOTE):
+    # Roda num processo do pool de upload: recebe os bytes, lê e valida a planilha (ou o extrato .csv/.txt, pelo perfil) inteira
+    # e devolve um único DataFrame sem attrs (o backend refaz nome/hash), para o retorno entre processos ser só os dados
+    try: partes = list(ler_extrato_em_lotes(io.BytesIO(dados), perfil, tamanho=tamanho) if perfil and eh_extrato_texto(nome) else ler_planilha_em_lotes(io.BytesIO(dados), tamanho=tamanho))
+    except Exception as e: return nome, None, f'Arquivo ilegível: {e}'
+    if not partes: return nome, None, 'Planilha vazia'
+    df = pd.concat(partes) if len(partes) > 1 else partes[0]
+    faltantes = [c for c in obrigatorias if c not in df.columns.str.lower().str.strip()]
+    if faltantes: return nome, None, f'Colunas faltando no Excel: {faltantes}'
+    df.attrs = {}
+    return nome, df, None
\ No newline at end of file
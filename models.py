@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, String, Integer, Float, Date, Text, Boolean
+from sqlalchemy import Column, String, Integer, BigInteger, Float, Date, DateTime, Text, Boolean, Index
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -67,19 +67,23 @@ class Lancamento(Base):
     cota = Column(String(50))
     tipo_cota = Column(String(100))
     parcela = Column(String(50))
+    # Parcela estruturada ("3/12" -> 3 e 12; estorno à parte), mantida junto com o texto acima
+    num_parcela = Column(Integer)
+    total_parcelas = Column(Integer)
+    is_estorno = Column(Boolean, default=False)
     
-    data_previsao = Column(Date)
+    data_previsao = Column(Date, index=True)
     data_real_recebimento = Column(Date, nullable=True)
     valor_recebido_real = Column(Float, nullable=True)
     valor_cliente = Column(Float, default=0.0)
     
     id_cliente = Column(String(50))
     cliente = Column(String(150))
-    id_vendedor = Column(String(50))
+    id_vendedor = Column(String(50), index=True)
     vendedor = Column(String(150))
-    id_supervisor = Column(String(50))
+    id_supervisor = Column(String(50), index=True)
     supervisor = Column(String(150))
-    id_gerente = Column(String(50))
+    id_gerente = Column(String(50), index=True)
     gerente = Column(String(150))
     
     receber_administradora = Column(Float, default=0.0)
@@ -88,10 +92,52 @@ class Lancamento(Base):
     pagar_gerente = Column(Float, default=0.0)
     liquido_caixa = Column(Float, default=0.0)
     
-    status_recebimento = Column(String(50), default='Pendente')
-    status_pgto_cliente = Column(String(50), default='Pendente')
-    status_pgto_vendedor = Column(String(50), default='Pendente')
-    status_pgto_supervisor = Column(String(50), default='Pendente')
-    status_pgto_gerente = Column(String(50), default='Pendente')
+    status_recebimento = Column(String(50), default='Pendente', index=True)
+    status_pgto_cliente = Column(String(50), default='Pendente', index=True)
+    status_pgto_vendedor = Column(String(50), default='Pendente', index=True)
+    status_pgto_supervisor = Column(String(50), default='Pendente', index=True)
+    status_pgto_gerente = Column(String(50), default='Pendente', index=True)
     
-    obs = Column(Text)
\ No newline at end of file
+    obs = Column(Text)
+    
+    # Controle de Sincronização (Delta): revisão da última escrita nesta linha
+    revisao = Column(BigInteger, default=0, server_default='0', index=True)
+
+    # Conciliação e cancelamentos buscam a parcela pela cota: busca indexada em vez de LIKE no texto
+    __table_args__ = (Index('ix_financeiro_grupo_cota_parcela', 'grupo', 'cota', 'num_parcela'),)
+
+class ControleRevisao(Base):
+    __tablename__ = 'controle_revisoes'
+    # Contador monotônico por tabela (incrementado a cada transação de escrita)
+    tabela = Column(String(50), primary_key=True)
+    revisao = Column(BigInteger, default=0)
+
+class LancamentoExcluido(Base):
+    __tablename__ = 'lancamentos_excluidos'
+    # Lápide dos lançamentos removidos, para o delta saber o que tirar da memória
+    id_lancamento = Column(String(100), primary_key=True)
+    revisao = Column(BigInteger, index=True)
+    data_exclusao = Column(DateTime)
+
+class CheckpointUpload(Base):
+    __tablename__ = 'checkpoints_upload'
+    # Progresso de um upload gravado em blocos: o reenvio do mesmo arquivo retoma após o último bloco confirmado
+    chave = Column(String(64), primary_key=True)
+    origem = Column(String(50))
+    linhas = Column(Integer, default=0)
+    data_atualizacao = Column(DateTime)
+
+class HistoricoImportacao(Base):
+    __tablename__ = 'historico_importacoes'
+    # Impressão digital de cada linha aplicada por upload (conciliação/cancelamentos), uma linha por parcela tocada:
+    # o reenvio da mesma linha é pulado sem consultar o ledger, e dá para ver qual arquivo baixou/cancelou cada parcela
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    origem = Column(String(50))
+    hash_linha = Column(String(64))
+    hash_arquivo = Column(String(64), index=True)
+    arquivo = Column(String(255))
+    linha = Column(Integer)
+    id_lancamento = Column(String(100), index=True)
+    data_importacao = Column(DateTime)
+
+    __table_args__ = (Index('ix_historico_origem_hash', 'origem', 'hash_linha'),)
\ No newline at end of file